@@ -1,15 +1,28 @@
 from airtable import Airtable
+import logging
 import os
+import sqlite3
+import threading
 from dotenv import load_dotenv
 
+from app_logging import get_logger
+from profiling import profiled
+
 # Load environment variables
 load_dotenv()
 
+logger = get_logger("airtable")
+
 # Airtable credentials and config
 AIRTABLE_BASE_ID = os.getenv("AIRTABLE_BASE_ID")
 AIRTABLE_TABLE_NAME = os.getenv("AIRTABLE_TABLE_NAME")
 AIRTABLE_TOKEN = os.getenv("AIRTABLE_PERSONAL_TOKEN")
 
+# Local Email_ID -> Airtable record id index, so status updates are a single PATCH
+# instead of a table scan.
+AIRTABLE_INDEX_PATH = os.getenv("AIRTABLE_INDEX_PATH", "airtable_index.db")
+AIRTABLE_BATCH_SIZE = 10  # Airtable accepts at most 10 records per create/update request
+
 # Initialize Airtable client
 airtable_client_initialized = False
 airtable = None
@@ -17,12 +30,172 @@ if AIRTABLE_BASE_ID and AIRTABLE_TABLE_NAME and AIRTABLE_TOKEN:
     try:
         airtable = Airtable(AIRTABLE_BASE_ID, AIRTABLE_TABLE_NAME, api_key=AIRTABLE_TOKEN)
         airtable_client_initialized = True
-        print("✅ Airtable client initialized successfully.")
+        logger.info("✅ Airtable client initialized successfully.")
     except Exception as e:
-        print(f"⚠️ Failed to initialize Airtable client: {e}. Logging to Airtable will be skipped.")
+        logger.warning(f"⚠️ Failed to initialize Airtable client: {e}. Logging to Airtable will be skipped.")
 else:
-    print("⚠️ Airtable credentials not found in environment. Logging to Airtable will be skipped.")
+    logger.warning("⚠️ Airtable credentials not found in environment. Logging to Airtable will be skipped.")
+
+class AirtableRecordIndex:
+    """
+    Maps Email_ID to Airtable record id in a local SQLite file.
+    Entries are added when we insert a record, and misses are resolved lazily
+    with a filterByFormula query for just the missing ids.
+    Safe to share between threads (mailbox sorter threads log concurrently).
+    """
+
+    def __init__(self, path=AIRTABLE_INDEX_PATH):
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS records (email_id TEXT PRIMARY KEY, record_id TEXT NOT NULL)"
+        )
+        self.conn.commit()
+
+    def get(self, email_id):
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT record_id FROM records WHERE email_id = ?", (email_id,)
+            ).fetchone()
+        return row[0] if row else None
+
+    def put_many(self, pairs):
+        with self.lock:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO records (email_id, record_id) VALUES (?, ?)", pairs
+            )
+            self.conn.commit()
+
+    def forget(self, email_ids):
+        """Drops cached record ids, e.g. after Airtable reported the row no longer exists."""
+        with self.lock:
+            self.conn.executemany("DELETE FROM records WHERE email_id = ?", [(email_id,) for email_id in email_ids])
+            self.conn.commit()
+
+    def resolve(self, email_ids):
+        """Returns {email_id: record_id} for every id that exists in Airtable, fetching only unknown ids."""
+        resolved = {}
+        missing = []
+        for email_id in email_ids:
+            record_id = self.get(email_id)
+            if record_id:
+                resolved[email_id] = record_id
+            else:
+                missing.append(email_id)
+
+        for i in range(0, len(missing), AIRTABLE_BATCH_SIZE):
+            chunk = missing[i:i + AIRTABLE_BATCH_SIZE]
+            clauses = ",".join("{Email_ID}='%s'" % email_id.replace("'", "\\'") for email_id in chunk)
+            found = airtable.get_all(formula=f"OR({clauses})", fields=["Email_ID"])
+            pairs = [(rec["fields"].get("Email_ID"), rec["id"]) for rec in found if rec["fields"].get("Email_ID")]
+            self.put_many(pairs)
+            resolved.update(dict(pairs))
+        return resolved
+
+
+_record_index = None
+_record_index_lock = threading.Lock()
+
+
+def get_record_index():
+    global _record_index
+    with _record_index_lock:
+        if _record_index is None:
+            _record_index = AirtableRecordIndex()
+    return _record_index
+
+
+def _safe_str(val, max_len=1000):
+    return str(val)[:max_len-3] + "..." if len(str(val)) > max_len else str(val)
+
+
+@profiled("airtable.upsert")
+def upsert_emails_to_airtable(records):
+    """
+    Inserts or updates a batch of rows keyed by Email_ID.
+    `records` is a list of field dicts; each must contain "Email_ID". Rows already in
+    Airtable get a partial PATCH with only the given fields, in requests of 10.
+    Returns the number of rows written.
+    """
+    if not airtable_client_initialized or not airtable:
+        logger.debug(f"ℹ️ Skipping Airtable upsert of {len(records)} records (Airtable client not initialized).")
+        return 0
+
+    try:
+        index = get_record_index()
+        existing = index.resolve([fields["Email_ID"] for fields in records])
+
+        updates = [{"id": existing[fields["Email_ID"]], "fields": fields}
+                   for fields in records if fields["Email_ID"] in existing]
+        inserts = [fields for fields in records if fields["Email_ID"] not in existing]
+
+        for i in range(0, len(updates), AIRTABLE_BATCH_SIZE):
+            chunk = updates[i:i + AIRTABLE_BATCH_SIZE]
+            try:
+                airtable.batch_update(chunk)
+            except Exception as e:
+                # A cached record id may be stale (row deleted in Airtable): look the chunk up again,
+                # update the rows that still exist and re-insert the rest.
+                logger.warning(f"⚠️ Airtable batch update failed ({e}); re-resolving {len(chunk)} record ids.")
+                email_ids = [update["fields"]["Email_ID"] for update in chunk]
+                index.forget(email_ids)
+                found = index.resolve(email_ids)
+                retry = [{"id": found[email_id], "fields": update["fields"]}
+                         for email_id, update in zip(email_ids, chunk) if email_id in found]
+                if retry:
+                    airtable.batch_update(retry)
+                inserts.extend(update["fields"] for email_id, update in zip(email_ids, chunk) if email_id not in found)
+        for i in range(0, len(inserts), AIRTABLE_BATCH_SIZE):
+            created = airtable.batch_insert(inserts[i:i + AIRTABLE_BATCH_SIZE])
+            index.put_many([(rec["fields"].get("Email_ID"), rec["id"]) for rec in created])
+
+        logger.info(f"✅ Upserted {len(records)} records to Airtable ({len(records) - len(inserts)} updated, {len(inserts)} inserted).")
+        return len(records)
+
+    except Exception as e:
+        logger.error(f"❌ Failed to upsert {len(records)} records to Airtable: {e}")
+        return 0
+
 
+@profiled("airtable.update_status")
+def update_email_status(email_id, status=None, reply_sent=None, notes=None):
+    """Partially updates the Airtable row for an email; only the fields passed are sent."""
+    fields = {"Email_ID": _safe_str(email_id)}
+    if status is not None:
+        fields["Status"] = _safe_str(status)
+    if reply_sent is not None:
+        fields["Reply_Sent"] = bool(reply_sent)
+    if notes is not None:
+        fields["Notes"] = _safe_str(notes)
+
+    if not airtable_client_initialized or not airtable:
+        logger.debug(f"ℹ️ Skipping Airtable status update for email ID {email_id} (Airtable client not initialized).")
+        return False
+
+    try:
+        index = get_record_index()
+        record_id = index.resolve([fields["Email_ID"]]).get(fields["Email_ID"])
+        if record_id:
+            try:
+                airtable.update(record_id, fields)
+            except Exception as e:
+                # The cached record id may be stale (row deleted in Airtable): forget it and look the row up again.
+                logger.warning(f"⚠️ Airtable update of record {record_id} failed ({e}); re-resolving email ID {email_id}.")
+                index.forget([fields["Email_ID"]])
+                record_id = index.resolve([fields["Email_ID"]]).get(fields["Email_ID"])
+                if record_id:
+                    airtable.update(record_id, fields)
+        if not record_id:
+            logger.warning(f"⚠️ No Airtable row found for email ID {email_id}; status not updated.")
+            return False
+        logger.debug(f"✅ Updated Airtable status for email ID {email_id}: {fields}")
+        return True
+    except Exception as e:
+        logger.error(f"❌ Failed to update Airtable status for email ID {email_id}: {e}")
+        return False
+
+
+@profiled("airtable.log")
 def log_email_to_airtable(
     email_id,
     from_email,
@@ -37,9 +210,15 @@ def log_email_to_airtable(
     reply_sent,
     notes
 ):
+    """
+    Writes the row for one email through upsert_emails_to_airtable, so logging the same
+    email twice (e.g. after a crash before the ledger recorded it) updates its row.
+    Returns True when the row was written, False when the write failed, and None when
+    Airtable is not configured and logging is skipped.
+    """
     if not airtable_client_initialized or not airtable:
-        print(f"ℹ️ Skipping Airtable log for email: {email_subject} (Airtable client not initialized).")
-        return
+        logger.debug(f"ℹ️ Skipping Airtable log for email: {email_subject} (Airtable client not initialized).")
+        return None
 
     try:
         # Guard against nulls
@@ -48,8 +227,7 @@ def log_email_to_airtable(
         email_attachments = email_attachments or []
 
         # Sanitize and truncate fields
-        def safe_str(val, max_len=1000):
-            return str(val)[:max_len-3] + "..." if len(str(val)) > max_len else str(val)
+        safe_str = _safe_str
 
         fields = {
             "Email_ID": safe_str(email_id),
@@ -57,7 +235,7 @@ def log_email_to_airtable(
             "Email_Subject": safe_str(email_subject),
             "Email_Content": safe_str(email_content),
             "Email_Attachments": safe_str(
-                [att["filename"] for att in email_attachments]
+                [att.get("filename", att.get("name")) for att in email_attachments]
             ) if isinstance(email_attachments, list) else safe_str(email_attachments),
             "Attachments_Names": ", ".join(map(str, attachments_names)) if isinstance(attachments_names, list) else safe_str(attachments_names),
             "Attachments_Types": ", ".join(map(str, attachments_types)) if isinstance(attachments_types, list) else safe_str(attachments_types),
@@ -68,16 +246,39 @@ def log_email_to_airtable(
             "Notes": safe_str(notes)
         }
 
-        print(f"🔄 Logging email: {email_subject}")
-        print("📤 Final fields being sent to Airtable:")
-        for key, value in fields.items():
-            print(f"  {key}: {type(value)} → {str(value)[:100]}")
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"🔄 Logging email: {email_subject}")
+            logger.debug("📤 Final fields being sent to Airtable:")
+            for key, value in fields.items():
+                logger.debug(f"  {key}: {type(value)} → {str(value)[:100]}")
 
-        airtable.insert(fields)
-        print(f"✅ Logged email to Airtable: {email_subject}")
+        if not upsert_emails_to_airtable([fields]):
+            return False
+        logger.debug(f"✅ Logged email to Airtable: {email_subject}")
+        return True
 
     except Exception as e:
-        print(f"❌ Failed to log email to Airtable for subject '{email_subject}': {e}")
+        logger.error(f"❌ Failed to log email to Airtable for subject '{email_subject}': {e}")
+        return False
 
     except Exception as e:
-        print(f"❌ Failed to log email to Airtable for subject '{email_subject}': {e}")
+        logger.error(f"❌ Failed to log email to Airtable for subject '{email_subject}': {e}")
+
+
+def log_email_record_to_airtable(record, attachments, category, po_detected, status, reply_sent, notes):
+    """Logs an EmailRecord (see email_record.py) with its non-inline attachment metadata."""
+    attachments = attachments or []
+    return log_email_to_airtable(
+        email_id=record.id,
+        from_email=record.sender,
+        email_subject=record.subject,
+        email_content=record.body,
+        email_attachments=attachments,
+        attachments_names=[att.get("name", "") for att in attachments],
+        attachments_types=[att.get("contentType", "") for att in attachments],
+        po_detected=po_detected,
+        category=category,
+        status=status,
+        reply_sent=reply_sent,
+        notes=notes
+    )
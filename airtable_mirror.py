@@ -0,0 +1,150 @@
+import argparse
+import os
+import sqlite3
+from datetime import datetime, timedelta, timezone
+from dotenv import load_dotenv
+
+from airtable_logger import airtable, airtable_client_initialized
+from app_logging import get_logger
+
+load_dotenv()
+
+logger = get_logger("mirror")
+
+# Local SQLite copy of the Airtable email log, for analytics without paging the API.
+AIRTABLE_MIRROR_PATH = os.getenv("AIRTABLE_MIRROR_PATH", "airtable_mirror.db")
+
+# Re-read a small window before the last cursor so edits made while a sync was running are not missed.
+SYNC_OVERLAP = timedelta(minutes=2)
+
+# Airtable field name -> local column name, for the fields written by log_email_to_airtable.
+MIRRORED_FIELDS = {
+    "Email_ID": "email_id",
+    "From_Email": "from_email",
+    "Email_Subject": "email_subject",
+    "Attachments_Names": "attachments_names",
+    "Attachments_Types": "attachments_types",
+    "PO_Detected": "po_detected",
+    "Category": "category",
+    "Status": "status",
+    "Reply_Sent": "reply_sent",
+    "Notes": "notes",
+}
+BOOLEAN_FIELDS = {"PO_Detected", "Reply_Sent"}  # Airtable omits unchecked checkboxes
+
+
+def connect(path=AIRTABLE_MIRROR_PATH):
+    conn = sqlite3.connect(path)
+    columns = ", ".join(
+        f"{column} {'INTEGER' if name in BOOLEAN_FIELDS else 'TEXT'}" for name, column in MIRRORED_FIELDS.items()
+    )
+    conn.execute(
+        f"CREATE TABLE IF NOT EXISTS emails (record_id TEXT PRIMARY KEY, created_time TEXT, sender_domain TEXT, {columns})"
+    )
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_emails_category ON emails (category)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_emails_sender_domain ON emails (sender_domain)")
+    conn.execute("CREATE TABLE IF NOT EXISTS sync_state (key TEXT PRIMARY KEY, value TEXT)")
+    conn.commit()
+    return conn
+
+
+def _row_from_record(record):
+    fields = record.get("fields", {})
+    row = {"record_id": record["id"], "created_time": record.get("createdTime")}
+    for airtable_name, column in MIRRORED_FIELDS.items():
+        value = fields.get(airtable_name)
+        if airtable_name in BOOLEAN_FIELDS:
+            value = 1 if value else 0
+        row[column] = value
+    from_email = (fields.get("From_Email") or "").lower()
+    row["sender_domain"] = from_email.rsplit("@", 1)[1] if "@" in from_email else None
+    return row
+
+
+def sync_mirror(conn=None, full=False):
+    """
+    Pulls records modified since the last sync into the local mirror.
+    Pass full=True to re-read the whole table (e.g. after deleting rows in Airtable).
+    Returns the number of records written.
+    """
+    if not airtable_client_initialized or not airtable:
+        logger.info("ℹ️ Skipping Airtable mirror sync (Airtable client not initialized).")
+        return 0
+
+    conn = conn or connect()
+    cursor_row = conn.execute("SELECT value FROM sync_state WHERE key = 'last_modified_cursor'").fetchone()
+    sync_started = datetime.now(timezone.utc)
+
+    formula = None
+    if cursor_row and not full:
+        since = datetime.fromisoformat(cursor_row[0]) - SYNC_OVERLAP
+        formula = f"IS_AFTER(LAST_MODIFIED_TIME(), DATETIME_PARSE('{since.strftime('%Y-%m-%dT%H:%M:%SZ')}'))"
+        logger.info(f"🔄 Incremental Airtable mirror sync (changes since {since.isoformat()})...")
+    else:
+        logger.info("🔄 Full Airtable mirror sync...")
+
+    columns = ["record_id", "created_time", "sender_domain"] + list(MIRRORED_FIELDS.values())
+    placeholders = ", ".join("?" for _ in columns)
+    written = 0
+    for page in airtable.get_iter(formula=formula, fields=list(MIRRORED_FIELDS)):
+        rows = [_row_from_record(record) for record in page]
+        conn.executemany(
+            f"INSERT OR REPLACE INTO emails ({', '.join(columns)}) VALUES ({placeholders})",
+            [tuple(row[column] for column in columns) for row in rows]
+        )
+        written += len(rows)
+
+    conn.execute(
+        "INSERT OR REPLACE INTO sync_state (key, value) VALUES ('last_modified_cursor', ?)",
+        (sync_started.isoformat(),)
+    )
+    conn.commit()
+    logger.info(f"✅ Mirrored {written} Airtable records to {AIRTABLE_MIRROR_PATH}.")
+    return written
+
+
+# --- Local aggregate queries ---
+
+def category_counts(conn):
+    return conn.execute(
+        "SELECT category, COUNT(*) FROM emails GROUP BY category ORDER BY COUNT(*) DESC"
+    ).fetchall()
+
+
+def po_detection_rate(conn):
+    total, detected = conn.execute("SELECT COUNT(*), COALESCE(SUM(po_detected), 0) FROM emails").fetchone()
+    return (detected / total) if total else 0.0
+
+
+def top_senders(conn, limit=10, by_domain=False):
+    column = "sender_domain" if by_domain else "LOWER(from_email)"
+    return conn.execute(
+        f"""
+        SELECT {column} AS sender, COUNT(*) AS total, SUM(po_detected) AS po_count
+        FROM emails WHERE {column} IS NOT NULL AND {column} != ''
+        GROUP BY sender ORDER BY total DESC LIMIT ?
+        """,
+        (limit,)
+    ).fetchall()
+
+
+def print_stats(conn):
+    print("\n--- Emails per category ---")
+    for category, count in category_counts(conn):
+        print(f"  {category}: {count}")
+    print(f"\nPO detection rate: {po_detection_rate(conn):.1%}")
+    print("\n--- Top sender domains ---")
+    for domain, total, po_count in top_senders(conn, by_domain=True):
+        print(f"  {domain}: {total} emails, {po_count} POs")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Mirror the Airtable email log locally and query it.")
+    parser.add_argument("command", choices=["sync", "stats"])
+    parser.add_argument("--full", action="store_true", help="Re-read the whole table instead of only recent changes.")
+    args = parser.parse_args()
+
+    mirror_conn = connect()
+    if args.command == "sync":
+        sync_mirror(mirror_conn, full=args.full)
+    print_stats(mirror_conn)
@@ -0,0 +1,77 @@
+import atexit
+import json
+import logging
+import os
+import queue
+import sys
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Log records are handed to a background thread through a queue, so a slow stdout
+# (e.g. a container log driver) never holds up the sorting loop.
+#   LOG_LEVEL=DEBUG   also shows per-email/per-request detail (off by default)
+#   LOG_FORMAT=text   human-readable lines instead of one JSON object per line
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json").lower()
+LOG_ROOT = "csr"
+
+_listener = None
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line: timestamp, level, logger, message and any structured fields."""
+
+    def format(self, record):
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        entry.update(getattr(record, "fields", {}))
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str, ensure_ascii=False)
+
+
+class TextFormatter(logging.Formatter):
+    def __init__(self):
+        super().__init__("%(asctime)s %(levelname)-7s %(name)s: %(message)s")
+
+    def format(self, record):
+        line = super().format(record)
+        fields = getattr(record, "fields", None)
+        if fields:
+            line += " " + " ".join(f"{key}={value}" for key, value in fields.items() if key != "event")
+        return line
+
+
+def configure_logging(level=LOG_LEVEL, log_format=LOG_FORMAT, stream=None):
+    """Installs the queue handler on the 'csr' logger and starts the writer thread (once per process)."""
+    global _listener
+    if _listener is not None:
+        return
+    log_queue = queue.SimpleQueue()
+    handler = logging.StreamHandler(stream or sys.stdout)
+    handler.setFormatter(JsonFormatter() if log_format == "json" else TextFormatter())
+    root = logging.getLogger(LOG_ROOT)
+    root.setLevel(level)
+    root.addHandler(QueueHandler(log_queue))
+    root.propagate = False
+    _listener = QueueListener(log_queue, handler)
+    _listener.start()
+    atexit.register(_listener.stop)  # flushes whatever is still queued
+
+
+def get_logger(name):
+    configure_logging()
+    return logging.getLogger(f"{LOG_ROOT}.{name}")
+
+
+def log_event(logger, event, level=logging.INFO, **fields):
+    """Logs one structured line; with LOG_FORMAT=json the fields become top-level keys."""
+    if logger.isEnabledFor(level):
+        logger.log(level, event, extra={"fields": {"event": event, **fields}})
@@ -0,0 +1,296 @@
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import time
+import zlib
+from dotenv import load_dotenv
+
+from graph_helper import stream_attachment_content
+from app_logging import get_logger
+from profiling import profiled
+
+load_dotenv()
+
+logger = get_logger("attachments")
+
+# Optional stage: download PDF attachments and look for PO numbers in their text,
+# for POs whose file name gives nothing away (e.g. "Document.pdf").
+ATTACHMENT_SCAN_ENABLED = os.getenv("ATTACHMENT_SCAN_ENABLED", "false").lower() == "true"
+ATTACHMENT_SCAN_MAX_BYTES = int(os.getenv("ATTACHMENT_SCAN_MAX_BYTES", str(5 * 1024 * 1024)))
+ATTACHMENT_CACHE_PATH = os.getenv("ATTACHMENT_CACHE_PATH", "attachment_cache.db")
+
+# Scans are cached by a hash of the full content plus the declared size. A hash of the first
+# 64 KiB is stored alongside: when it matches an earlier scan, the rest of the download is
+# only hashed, not parsed, and the cached result is used once the full hash confirms it.
+CACHE_KEY_PREFIX_BYTES = 64 * 1024
+
+PO_TEXT_PATTERNS = [
+    re.compile(r"\bp[./]?\s?o\.?\s*(?:number|no\.?|#|num)?\s*:?-?\s*(\d{4,12})\b", re.IGNORECASE),
+    re.compile(r"\bpurchase\s+order\s*(?:number|no\.?|#|num)?\s*:?-?\s*(\d{4,12})\b", re.IGNORECASE),
+]
+MAX_PO_NUMBERS = 10
+
+_STREAM_START = re.compile(rb"stream\r?\n")
+_STREAM_END = b"endstream"
+# Text-showing operators: "[...] TJ" arrays and single strings before Tj, ' or ".
+# Strings are literal "(...)" or hex "<...>".
+_STRING = rb"\((?:\\.|[^\\()])*\)|<[0-9A-Fa-f\s]*>"
+_TEXT_OPERATOR = re.compile(rb"\[((?:" + _STRING + rb"|[^\]()<])*)\]\s*TJ|(" + _STRING + rb")\s*(?:Tj|'|\")")
+_ARRAY_STRING = re.compile(_STRING)
+_LITERAL_ESCAPE = re.compile(rb"\\([0-7]{1,3}|\r\n|[\s\S])")
+_LITERAL_ESCAPES = {b"n": b"\n", b"r": b"\r", b"t": b"\t", b"b": b"\b", b"f": b"\f", b"\r\n": b"", b"\n": b"", b"\r": b""}
+_SKIPPED_FILTERS = (b"/DCTDecode", b"/JPXDecode", b"/CCITTFaxDecode", b"/JBIG2Decode", b"/Image")
+
+# Bounds on the rolling buffers kept between chunks.
+_MAX_HEADER_TAIL = 2048
+_MAX_CONTENT_TAIL = 4096
+_TEXT_OVERLAP = 64
+_MAX_INFLATE_SLICE = 256 * 1024
+
+
+class PdfTextScanner:
+    """
+    Incremental PDF text extractor. Feed raw PDF bytes in any chunk sizes; content
+    streams are inflated on the fly and the text shown by Tj/TJ operators is matched
+    against PO_TEXT_PATTERNS. Memory stays bounded by the rolling buffers above.
+    """
+
+    def __init__(self):
+        self.header = b""          # bytes outside a stream, looking for the next "stream" keyword
+        self.in_stream = False
+        self.skip_stream = False
+        self.inflater = None
+        self.stream_tail = b""     # last bytes of stream data, in case "endstream" spans chunks
+        self.content_tail = b""    # decoded content after the last complete text operator
+        self.text_tail = ""        # last characters of extracted text, for matches across chunks
+        self.po_numbers = []
+
+    def feed(self, chunk):
+        data = chunk
+        while data:
+            if not self.in_stream:
+                buffer = self.header + data
+                match = _STREAM_START.search(buffer)
+                if not match:
+                    self.header = buffer[-_MAX_HEADER_TAIL:]
+                    return
+                dictionary = buffer[max(0, match.start() - _MAX_HEADER_TAIL):match.start()]
+                dictionary = dictionary[dictionary.rfind(b"<<"):] if b"<<" in dictionary else dictionary
+                self.skip_stream = any(f in dictionary for f in _SKIPPED_FILTERS)
+                self.inflater = zlib.decompressobj() if b"/FlateDecode" in dictionary else None
+                self.in_stream = True
+                self.header = b""
+                self.stream_tail = b""
+                data = buffer[match.end():]
+            else:
+                buffer = self.stream_tail + data
+                end = buffer.find(_STREAM_END)
+                if end == -1:
+                    keep = len(_STREAM_END) - 1
+                    self._consume_stream(buffer[:-keep] if len(buffer) > keep else b"")
+                    self.stream_tail = buffer[-keep:] if len(buffer) > keep else buffer
+                    return
+                self._consume_stream(buffer[:end])
+                self.in_stream = False
+                self.inflater = None
+                self.content_tail = b""
+                data = buffer[end + len(_STREAM_END):]
+
+    def _consume_stream(self, raw):
+        if not raw or self.skip_stream:
+            return
+        if self.inflater is None:
+            self._extract_text(raw)
+            return
+        try:
+            # Inflate in bounded slices so a highly compressed stream cannot blow up memory.
+            content = self.inflater.decompress(raw, _MAX_INFLATE_SLICE)
+            self._extract_text(content)
+            while self.inflater.unconsumed_tail and not self.inflater.eof:
+                content = self.inflater.decompress(self.inflater.unconsumed_tail, _MAX_INFLATE_SLICE)
+                self._extract_text(content)
+        except zlib.error:
+            self.skip_stream = True
+
+    def _extract_text(self, content):
+        buffer = self.content_tail + content
+        last_end = 0
+        pieces = []
+        for match in _TEXT_OPERATOR.finditer(buffer):
+            if match.group(1) is not None:
+                # TJ array: the numbers between strings are kerning, so the strings join directly.
+                pieces.append("".join(_decode_string(s) for s in _ARRAY_STRING.findall(match.group(1))))
+            else:
+                pieces.append(_decode_string(match.group(2)))
+            last_end = match.end()
+        # An operator cut off at the end of this slice is completed by the next one.
+        self.content_tail = buffer[last_end:][-_MAX_CONTENT_TAIL:]
+        if pieces:
+            self._search_text(" ".join(pieces))
+
+    def _search_text(self, text):
+        window = self.text_tail + " " + text
+        for pattern in PO_TEXT_PATTERNS:
+            for match in pattern.finditer(window):
+                number = match.group(1)
+                if number not in self.po_numbers and len(self.po_numbers) < MAX_PO_NUMBERS:
+                    self.po_numbers.append(number)
+        self.text_tail = window[-_TEXT_OVERLAP:]
+
+
+def _decode_string(token):
+    """Text of a PDF literal "(...)" or hex "<...>" string token."""
+    if token.startswith(b"<"):
+        digits = re.sub(rb"\s", b"", token[1:-1])
+        if len(digits) % 2:
+            digits += b"0"
+        return bytes.fromhex(digits.decode("ascii")).decode("latin-1")
+    return _LITERAL_ESCAPE.sub(_unescape, token[1:-1]).decode("latin-1")
+
+
+def _unescape(match):
+    escape = match.group(1)
+    if escape[:1].isdigit():
+        return bytes([int(escape, 8) & 0xFF])
+    return _LITERAL_ESCAPES.get(escape, escape)
+
+
+class AttachmentScanCache:
+    """SQLite cache of scan results keyed by attachment content, shared across forwards and runs."""
+
+    def __init__(self, path=ATTACHMENT_CACHE_PATH):
+        self.conn = sqlite3.connect(path)
+        columns = {row[1] for row in self.conn.execute("PRAGMA table_info(attachment_scans)")}
+        if columns and "prefix_key" not in columns:
+            # Entries from before full-content keys can't be verified; it is only a cache.
+            self.conn.execute("DROP TABLE attachment_scans")
+        self.conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS attachment_scans (
+                content_key TEXT PRIMARY KEY,
+                prefix_key TEXT NOT NULL,
+                po_numbers TEXT NOT NULL,
+                bytes_read INTEGER NOT NULL,
+                truncated INTEGER NOT NULL,
+                scanned_at REAL NOT NULL
+            )
+            """
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS idx_attachment_scans_prefix ON attachment_scans (prefix_key)")
+        self.conn.commit()
+
+    def _lookup(self, column, key):
+        row = self.conn.execute(
+            f"SELECT content_key, po_numbers, bytes_read, truncated FROM attachment_scans WHERE {column} = ? "
+            "ORDER BY scanned_at DESC LIMIT 1", (key,)
+        ).fetchone()
+        if not row:
+            return None
+        return {"content_key": row[0], "po_numbers": json.loads(row[1]), "bytes_read": row[2],
+                "truncated": bool(row[3]), "cached": True}
+
+    def get(self, content_key):
+        return self._lookup("content_key", content_key)
+
+    def get_by_prefix(self, prefix_key):
+        """Most recent scan whose first 64 KiB hashed the same; a candidate until the full hash agrees."""
+        return self._lookup("prefix_key", prefix_key)
+
+    def put(self, content_key, prefix_key, result):
+        self.conn.execute(
+            "INSERT OR REPLACE INTO attachment_scans (content_key, prefix_key, po_numbers, bytes_read, truncated, scanned_at) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            (content_key, prefix_key, json.dumps(result["po_numbers"]), result["bytes_read"], int(result["truncated"]),
+             time.time())
+        )
+        self.conn.commit()
+
+
+def scan_attachment(message_id, attachment, cache, max_bytes=ATTACHMENT_SCAN_MAX_BYTES, mailbox=None):
+    """
+    Streams one PDF attachment and returns {"po_numbers", "bytes_read", "truncated", "cached"}.
+    At most `max_bytes` are downloaded (and hashed); a file cut off there is keyed by what was read.
+    """
+    result = _scan_attachment(message_id, attachment, cache, max_bytes, mailbox, trust_prefix=True)
+    if result is None:
+        # Same first 64 KiB as a cached file but different content: parse it after all.
+        result = _scan_attachment(message_id, attachment, cache, max_bytes, mailbox, trust_prefix=False)
+    return result
+
+
+def _scan_attachment(message_id, attachment, cache, max_bytes, mailbox, trust_prefix):
+    """Returns the scan result, or None when a prefix match turned out to be a different file."""
+    chunks = stream_attachment_content(message_id, attachment["id"], mailbox=mailbox)
+    scanner = PdfTextScanner()
+    hasher = hashlib.sha256()
+    prefix = b""
+    prefix_key = None
+    candidate = None
+    bytes_read = 0
+    truncated = False
+    try:
+        for chunk in chunks:
+            if bytes_read + len(chunk) > max_bytes:
+                chunk = chunk[:max_bytes - bytes_read]
+                truncated = True
+            bytes_read += len(chunk)
+            hasher.update(chunk)
+
+            if prefix_key is None:
+                prefix += chunk
+                if len(prefix) < CACHE_KEY_PREFIX_BYTES and not truncated:
+                    continue
+                prefix_key = _content_key(hashlib.sha256(prefix[:CACHE_KEY_PREFIX_BYTES]), attachment.get("size"))
+                candidate = cache.get_by_prefix(prefix_key) if trust_prefix else None
+                chunk, prefix = prefix, b""
+            if candidate is None:
+                scanner.feed(chunk)
+
+            if truncated:
+                break
+    finally:
+        chunks.close()
+
+    content_key = _content_key(hasher, attachment.get("size"))
+    if prefix_key is None:  # whole file was smaller than the prefix, so the prefix is the content
+        prefix_key = content_key
+        candidate = cache.get(content_key)
+        if candidate is None:
+            scanner.feed(prefix)
+
+    if candidate is not None:
+        if candidate.pop("content_key") != content_key:
+            return None
+        return candidate
+
+    result = {"po_numbers": scanner.po_numbers, "bytes_read": bytes_read, "truncated": truncated, "cached": False}
+    cache.put(content_key, prefix_key, result)
+    return result
+
+
+def _content_key(hasher, declared_size):
+    return f"{hasher.hexdigest()}:{declared_size}"
+
+
+@profiled("attachments.scan")
+def find_po_numbers_in_attachments(message_id, attachments, cache=None, mailbox=None):
+    """
+    Scans the PDF attachments of a message and returns the PO numbers found in their text.
+    Errors on individual attachments are reported and skipped.
+    """
+    cache = cache or AttachmentScanCache()
+    po_numbers = []
+    for att in attachments:
+        if att.get("contentType", "").lower() != "application/pdf" or not att.get("id"):
+            continue
+        try:
+            result = scan_attachment(message_id, att, cache, mailbox=mailbox)
+        except Exception as e:
+            logger.warning(f"Error scanning attachment '{att.get('name')}' of message ID {message_id}: {e}")
+            continue
+        source = "cache" if result["cached"] else f"{result['bytes_read']} bytes"
+        logger.debug(f"Scanned '{att.get('name')}' ({source}): PO numbers {result['po_numbers'] or 'none'}")
+        po_numbers.extend(n for n in result["po_numbers"] if n not in po_numbers)
+    return po_numbers
@@ -1,6 +1,7 @@
 import os
 import msal
 from dotenv import load_dotenv
+from profiling import profiled
 
 # Load environment variables from .env file
 load_dotenv()
@@ -29,14 +30,25 @@ if not CLIENT_ID or not CLIENT_SECRET or not TENANT_ID:
 AUTHORITY = f"https://login.microsoftonline.com/{TENANT_ID}"
 SCOPES = ["https://graph.microsoft.com/.default"] # Default scope for client credentials flow
 
+# One app per process so its in-memory token cache is reused; creating a new app on
+# every call meant every Graph request acquired a fresh token.
+_app = None
+
+def _get_app():
+    global _app
+    if _app is None:
+        _app = msal.ConfidentialClientApplication(
+            CLIENT_ID,
+            authority=AUTHORITY,
+            client_credential=CLIENT_SECRET
+        )
+    return _app
+
+@profiled("auth.get_access_token")
 def get_access_token():
     # app object creation and token acquisition should only happen if creds were found.
     # The check at the module level handles the exit if they are not.
-    app = msal.ConfidentialClientApplication(
-        CLIENT_ID,
-        authority=AUTHORITY,
-        client_credential=CLIENT_SECRET
-    )
+    app = _get_app()
 
     result = app.acquire_token_silent(SCOPES, account=None)
 
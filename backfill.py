@@ -0,0 +1,161 @@
+import argparse
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from dotenv import load_dotenv
+
+from graph_helper import get_folder_id, get_folder_messages_page, move_emails
+from email_ledger import EmailLedger
+from email_sorter import categorize_email, get_target_folder_ids, FOLDER_NEEDS_ATTENTION, FOLDER_QUOTE_REQUESTS, FOLDER_PURCHASE_ORDERS
+from app_logging import get_logger
+
+load_dotenv()
+
+logger = get_logger("backfill")
+
+# Re-classifies a whole folder after keyword changes in email_sorter. Nothing is moved
+# until the dry-run diff has been reviewed and applied with --apply.
+BACKFILL_PAGE_SIZE = int(os.getenv("BACKFILL_PAGE_SIZE", "100"))
+BACKFILL_CHUNK_SIZE = int(os.getenv("BACKFILL_CHUNK_SIZE", "8"))
+CATEGORY_FOLDERS = (FOLDER_NEEDS_ATTENTION, FOLDER_QUOTE_REQUESTS, FOLDER_PURCHASE_ORDERS)
+
+
+def _classify(email):
+    """Runs in a worker process; EmailRecords are compact enough to pickle as-is."""
+    return email.id, categorize_email(email, email.attachments or [])
+
+
+def _load_checkpoint(path):
+    if os.path.exists(path):
+        with open(path, "r") as f:
+            return json.load(f)
+    return None
+
+
+def _save_checkpoint(path, checkpoint):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(checkpoint, f, indent=2)
+    os.replace(tmp_path, path)
+
+
+def run_backfill(folder_name, diff_path, workers=None, page_size=BACKFILL_PAGE_SIZE, restart=False, mailbox=None):
+    """
+    Streams every message in `folder_name` page by page, re-classifies it in a process pool
+    and appends {"id", "subject", "old", "new"} lines to `diff_path` for messages whose
+    category would change. Progress is checkpointed after each page, so an interrupted
+    run continues where it stopped. `mailbox` defaults to SHARED_MAILBOX_ADDRESS.
+    """
+    checkpoint_path = f"{diff_path}.checkpoint.json"
+    checkpoint = None if restart else _load_checkpoint(checkpoint_path)
+    if checkpoint and (checkpoint.get("folder"), checkpoint.get("mailbox")) != (folder_name, mailbox):
+        logger.warning(f"Checkpoint {checkpoint_path} belongs to folder '{checkpoint.get('folder')}' of mailbox "
+                       f"{checkpoint.get('mailbox') or 'default'}; use --restart to discard it.")
+        return None
+    if checkpoint and checkpoint.get("done"):
+        logger.info(f"Backfill of '{folder_name}' already finished; diff is in {diff_path}. Use --restart to run it again.")
+        return checkpoint
+    if not checkpoint:
+        checkpoint = {"folder": folder_name, "mailbox": mailbox, "next_link": None, "pages": 0, "messages": 0, "changed": 0, "done": False}
+        if os.path.exists(diff_path):
+            os.remove(diff_path)
+    else:
+        logger.info(f"Resuming backfill of '{folder_name}' after {checkpoint['messages']} messages.")
+
+    folder_id = "inbox" if folder_name.lower() == "inbox" else get_folder_id(folder_name, parent_folder_id="inbox", mailbox=mailbox)
+    if not folder_id:
+        logger.error(f"Folder '{folder_name}' not found.")
+        return None
+
+    ledger = EmailLedger()
+    folder_category = folder_name if folder_name in CATEGORY_FOLDERS else None
+    started = time.monotonic()
+    session_messages = 0
+
+    with ProcessPoolExecutor(max_workers=workers) as pool, open(diff_path, "a") as diff_file:
+        while True:
+            messages, next_link = get_folder_messages_page(
+                folder_id, page_size=page_size, next_link=checkpoint["next_link"], mailbox=mailbox
+            )
+            if not messages and not next_link:
+                break
+
+            new_categories = dict(pool.map(_classify, messages, chunksize=BACKFILL_CHUNK_SIZE))
+
+            for email in messages:
+                email.release_body()
+                entry = ledger.get(email.id, email.internet_message_id, mailbox=mailbox)
+                old_category = folder_category or (entry or {}).get("category")
+                new_category = new_categories[email.id]
+                if new_category != old_category:
+                    diff_file.write(json.dumps({
+                        "id": email.id,
+                        "subject": email.subject,
+                        "old": old_category,
+                        "new": new_category
+                    }) + "\n")
+                    checkpoint["changed"] += 1
+            diff_file.flush()
+
+            checkpoint["pages"] += 1
+            checkpoint["messages"] += len(messages)
+            checkpoint["next_link"] = next_link
+            session_messages += len(messages)
+            _save_checkpoint(checkpoint_path, checkpoint)
+
+            elapsed = time.monotonic() - started
+            logger.info(f"Page {checkpoint['pages']}: {checkpoint['messages']} messages, {checkpoint['changed']} changes, "
+                        f"{session_messages / elapsed:.1f} msgs/s")
+            if not next_link:
+                break
+
+    checkpoint["done"] = True
+    _save_checkpoint(checkpoint_path, checkpoint)
+    ledger.close()
+    logger.info(f"✅ Backfill of '{folder_name}' finished: {checkpoint['messages']} messages, "
+                f"{checkpoint['changed']} would change category. Review {diff_path}, then run with --apply.")
+    return checkpoint
+
+
+def apply_diff(diff_path, mailbox=None):
+    """Moves the messages listed in a reviewed diff file to their new category folders."""
+    changes = {}
+    with open(diff_path, "r") as f:
+        for line in f:
+            if line.strip():
+                change = json.loads(line)
+                changes[change["id"]] = change["new"]  # a resumed run may repeat a page; last entry wins
+
+    folder_ids = get_target_folder_ids(mailbox=mailbox)
+    by_category = {}
+    for message_id, category in changes.items():
+        by_category.setdefault(category, []).append(message_id)
+
+    moved = 0
+    for category, message_ids in by_category.items():
+        if not folder_ids.get(category):
+            logger.warning(f"No destination folder ID found for '{category}'; skipping {len(message_ids)} messages.")
+            continue
+        results = move_emails(message_ids, folder_ids[category], mailbox=mailbox)
+        moved += sum(1 for result in results.values() if result is not None)
+    logger.info(f"✅ Applied backfill diff: moved {moved} of {len(changes)} messages.")
+    return moved
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Re-classify a whole mail folder and write a dry-run diff.")
+    parser.add_argument("folder", nargs="?", default="inbox", help="Folder name under the Inbox, or 'inbox'.")
+    parser.add_argument("--mailbox", default=None, help="Mailbox to backfill (default: SHARED_MAILBOX_ADDRESS).")
+    parser.add_argument("--diff", default="backfill_diff.jsonl", help="Diff file to write (or apply).")
+    parser.add_argument("--workers", type=int, default=None, help="Worker processes (default: CPU count).")
+    parser.add_argument("--page-size", type=int, default=BACKFILL_PAGE_SIZE)
+    parser.add_argument("--restart", action="store_true", help="Ignore any checkpoint and start over.")
+    parser.add_argument("--apply", action="store_true", help="Move messages according to an existing diff file.")
+    args = parser.parse_args()
+
+    if args.apply:
+        apply_diff(args.diff, mailbox=args.mailbox)
+    else:
+        run_backfill(args.folder, args.diff, workers=args.workers, page_size=args.page_size, restart=args.restart,
+                     mailbox=args.mailbox)
@@ -0,0 +1,293 @@
+import hashlib
+import html
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections import Counter, OrderedDict
+from dataclasses import dataclass
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Near-duplicate detection: the same PO sent twice, or one email CC'd to several of our
+# mailboxes, is recognised by a 64-bit SimHash of its normalized text and attachments and
+# routed like the copy we already classified, without another classification or crew run.
+# Similar text alone is not enough: a match also needs the same attachments (name and size)
+# or the same PO numbers, so two different POs from one template are never merged.
+DUPLICATE_INDEX_PATH = os.getenv("DUPLICATE_INDEX_PATH", "duplicate_index.db")
+DUPLICATE_MAX_DISTANCE = int(os.getenv("DUPLICATE_MAX_DISTANCE", "3"))  # differing bits out of 64
+DUPLICATE_MAX_ENTRIES = int(os.getenv("DUPLICATE_MAX_ENTRIES", "50000"))
+DUPLICATE_WINDOW_DAYS = float(os.getenv("DUPLICATE_WINDOW_DAYS", "14"))
+
+FINGERPRINT_BITS = 64
+# 4 bands of 16 bits: two fingerprints within 3 bits of each other agree on at least one band,
+# so a lookup only compares against the few fingerprints sharing a band.
+BAND_BITS = 16
+BAND_COUNT = FINGERPRINT_BITS // BAND_BITS
+SHINGLE_SIZE = 3
+ATTACHMENT_WEIGHT = 3  # an identical attachment (name and size) says more than a shared phrase
+
+SUBJECT_PREFIX_PATTERN = re.compile(r"^\s*((re|fw|fwd|aw|wg)\s*:\s*)+", re.IGNORECASE)
+SCRIPT_STYLE_PATTERN = re.compile(r"<(script|style)\b.*?</\1>", re.IGNORECASE | re.DOTALL)
+BLOCKQUOTE_PATTERN = re.compile(r"<blockquote\b.*?</blockquote>", re.IGNORECASE | re.DOTALL)
+LINE_BREAK_TAG_PATTERN = re.compile(r"<(br|/p|/div|/tr|/li|hr)\b[^>]*>", re.IGNORECASE)
+TAG_PATTERN = re.compile(r"<[^>]+>")
+WORD_PATTERN = re.compile(r"[a-z0-9]+")
+# Everything from the first of these lines on is quoted history or boilerplate, not this message.
+TRAILER_START_PATTERN = re.compile(
+    r"^\s*(-{2,}\s*original message\s*-{2,}"
+    r"|-{2,}\s*forwarded message\s*-{2,}"
+    r"|from:\s.+"                                       # Outlook reply header
+    r"|on\s.{0,200}\swrote:"                            # Gmail / Apple Mail reply header
+    r"|--\s*"                                           # signature delimiter
+    r"|(best|kind|warm)?\s*regards,?|sincerely,?|cheers,?|thanks( and regards)?,?|thank you,?"
+    r"|(confidentiality notice|disclaimer)\b.*"
+    r"|this (e-?mail|message)( and any attachments)? (is|are|may be) (confidential|intended).*)\s*$",
+    re.IGNORECASE | re.MULTILINE
+)
+PO_NUMBER_PATTERN = re.compile(r"\b(?:p\.?\s?o\.?|purchase\s+order)\s*(?:number|no\.?|#|num)?\s*:?-?\s*(\d{4,12})\b",
+                               re.IGNORECASE)
+
+
+def message_text(body):
+    """
+    Plain text of what this message itself says: markup, quoted replies, signatures and
+    disclaimers are removed, so a reply that quotes an earlier email doesn't resemble it.
+    """
+    text = SCRIPT_STYLE_PATTERN.sub(" ", body or "")
+    text = BLOCKQUOTE_PATTERN.sub("\n", text)
+    text = html.unescape(TAG_PATTERN.sub(" ", LINE_BREAK_TAG_PATTERN.sub("\n", text)))
+    text = "\n".join(line for line in text.splitlines() if not line.lstrip().startswith(">"))
+    trailer = TRAILER_START_PATTERN.search(text)
+    return text[:trailer.start()] if trailer else text
+
+
+def normalize_text(text):
+    """Lower-cased words of an HTML or plain-text body, without markup."""
+    text = SCRIPT_STYLE_PATTERN.sub(" ", text or "")
+    text = html.unescape(TAG_PATTERN.sub(" ", text))
+    return WORD_PATTERN.findall(text.lower())
+
+
+def email_features(subject, body, attachments):
+    """Weighted SimHash features: body shingles, subject words, and attachment name+size."""
+    words = normalize_text(message_text(body))
+    features = Counter(" ".join(words[i:i + SHINGLE_SIZE]) for i in range(max(len(words) - SHINGLE_SIZE + 1, 0)))
+    if 0 < len(words) < SHINGLE_SIZE:
+        features[" ".join(words)] += 1
+    for word in normalize_text(SUBJECT_PREFIX_PATTERN.sub("", subject or "")):
+        features[f"subject:{word}"] += 1
+    for att in attachments or []:
+        features[f"attachment:{(att.get('name') or '').lower()}:{att.get('size')}"] += ATTACHMENT_WEIGHT
+    return features
+
+
+def simhash(features):
+    """64-bit SimHash of a {feature: weight} mapping, or None when there is nothing to hash."""
+    if not features:
+        return None
+    totals = [0] * FINGERPRINT_BITS
+    for feature, weight in features.items():
+        h = int.from_bytes(hashlib.blake2b(feature.encode("utf-8"), digest_size=8).digest(), "big")
+        for bit in range(FINGERPRINT_BITS):
+            totals[bit] += weight if (h >> bit) & 1 else -weight
+    return sum(1 << bit for bit, total in enumerate(totals) if total > 0)
+
+
+def attachment_key(attachments):
+    """Order-independent key of an attachment set (name and size), or None without attachments."""
+    names = sorted(f"{(att.get('name') or '').lower()}:{att.get('size')}" for att in attachments or [])
+    return "|".join(names) or None
+
+
+def po_key(subject, body):
+    """Sorted PO numbers mentioned in the subject or the message's own text, or None."""
+    numbers = sorted(set(PO_NUMBER_PATTERN.findall(f"{subject or ''}\n{message_text(body)}")))
+    return ",".join(numbers) or None
+
+
+@dataclass(frozen=True, slots=True)
+class Fingerprint:
+    simhash: int | None
+    attachment_key: str | None = None
+    po_key: str | None = None
+
+    def corroborates(self, attachment_key, po_key):
+        """True when another message shares this one's (non-empty) attachment set or PO numbers."""
+        return bool((self.attachment_key and self.attachment_key == attachment_key)
+                    or (self.po_key and self.po_key == po_key))
+
+
+def email_fingerprint(email, attachments):
+    """Fingerprint of an EmailRecord (needs its body, so call it before release_body())."""
+    return Fingerprint(simhash(email_features(email.subject, email.body, attachments)),
+                       attachment_key(attachments), po_key(email.subject, email.body))
+
+
+def hamming_distance(a, b):
+    return (a ^ b).bit_count()
+
+
+def _bands(fingerprint):
+    mask = (1 << BAND_BITS) - 1
+    return [(band, (fingerprint >> (band * BAND_BITS)) & mask) for band in range(BAND_COUNT)]
+
+
+def _to_sqlite(fingerprint):
+    # SQLite integers are signed 64-bit
+    return fingerprint - (1 << 64) if fingerprint >= 1 << 63 else fingerprint
+
+
+def _from_sqlite(value):
+    return value + (1 << 64) if value < 0 else value
+
+
+class DuplicateIndex:
+    """
+    Recent fingerprints, kept in memory (bounded, oldest evicted first) and in SQLite so the
+    index survives restarts. Only originals are indexed; a duplicate points at its original.
+    Safe to share between threads.
+    """
+
+    def __init__(self, path=DUPLICATE_INDEX_PATH, max_entries=DUPLICATE_MAX_ENTRIES,
+                 window_days=DUPLICATE_WINDOW_DAYS, max_distance=DUPLICATE_MAX_DISTANCE):
+        self.max_entries = max_entries
+        self.max_distance = max_distance
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()  # message_id -> (simhash, category, attachment_key, po_key), oldest first
+        self.buckets = [{} for _ in range(BAND_COUNT)]  # band value -> set of message_ids
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS fingerprints (
+                message_id TEXT PRIMARY KEY,
+                fingerprint INTEGER,
+                category TEXT,
+                duplicate_of TEXT,
+                seen_at REAL NOT NULL,
+                attachment_key TEXT,
+                po_key TEXT
+            )
+            """
+        )
+        # Indexes from before the attachment/PO check get the columns; their old rows never match.
+        columns = {row[1] for row in self.conn.execute("PRAGMA table_info(fingerprints)")}
+        for column in ("attachment_key", "po_key"):
+            if column not in columns:
+                self.conn.execute(f"ALTER TABLE fingerprints ADD COLUMN {column} TEXT")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS idx_fingerprints_seen ON fingerprints (seen_at)")
+        self.conn.execute("DELETE FROM fingerprints WHERE seen_at < ?", (time.time() - window_days * 86400,))
+        self.conn.execute(
+            "DELETE FROM fingerprints WHERE message_id NOT IN "
+            "(SELECT message_id FROM fingerprints ORDER BY seen_at DESC LIMIT ?)", (max_entries,)
+        )
+        self.conn.commit()
+        rows = self.conn.execute(
+            "SELECT message_id, fingerprint, category, attachment_key, po_key FROM fingerprints "
+            "WHERE duplicate_of IS NULL AND fingerprint IS NOT NULL ORDER BY seen_at"
+        ).fetchall()
+        for message_id, fingerprint, category, attachments, po_numbers in rows:
+            self._remember(message_id, Fingerprint(_from_sqlite(fingerprint), attachments, po_numbers), category)
+
+    def _remember(self, message_id, fingerprint, category):
+        self.entries[message_id] = (fingerprint.simhash, category, fingerprint.attachment_key, fingerprint.po_key)
+        for band, value in _bands(fingerprint.simhash):
+            self.buckets[band].setdefault(value, set()).add(message_id)
+        while len(self.entries) > self.max_entries:
+            old_id, (old_simhash, *_) = self.entries.popitem(last=False)
+            for band, value in _bands(old_simhash):
+                bucket = self.buckets[band].get(value)
+                if bucket:
+                    bucket.discard(old_id)
+                    if not bucket:
+                        del self.buckets[band][value]
+
+    def _nearest(self, fingerprint):
+        if fingerprint.simhash is None or not (fingerprint.attachment_key or fingerprint.po_key):
+            return None  # nothing that could corroborate a text match
+        best = None
+        seen = set()
+        for band, value in _bands(fingerprint.simhash):
+            for candidate in self.buckets[band].get(value, ()):
+                if candidate in seen:
+                    continue
+                seen.add(candidate)
+                candidate_simhash, category, attachments, po_numbers = self.entries[candidate]
+                distance = hamming_distance(fingerprint.simhash, candidate_simhash)
+                if (distance <= self.max_distance and (best is None or distance < best["distance"])
+                        and fingerprint.corroborates(attachments, po_numbers)):
+                    best = {"message_id": candidate, "category": category, "distance": distance}
+        return best
+
+    def _recorded(self, message_id):
+        # (True, original or None) for a message checked before, (False, None) otherwise.
+        row = self.conn.execute(
+            "SELECT duplicate_of FROM fingerprints WHERE message_id = ?", (message_id,)
+        ).fetchone()
+        if row is None:
+            return False, None
+        if row[0] is None:
+            return True, None
+        original = self.conn.execute(
+            "SELECT category FROM fingerprints WHERE message_id = ?", (row[0],)
+        ).fetchone()
+        return True, {"message_id": row[0], "category": original[0] if original else None, "distance": None}
+
+    def check(self, message_id, fingerprint, category=None):
+        """
+        Returns {"message_id", "category", "distance"} of the original if this message is a
+        near-duplicate of one already seen, else None (and the message is indexed as an original).
+        Checking the same message again gives the same answer.
+        """
+        with self.lock:
+            recorded, original = self._recorded(message_id)
+            if recorded:
+                return original
+
+            match = self._nearest(fingerprint)
+            self.conn.execute(
+                "INSERT INTO fingerprints (message_id, fingerprint, category, duplicate_of, seen_at, attachment_key, po_key) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (message_id, _to_sqlite(fingerprint.simhash) if fingerprint.simhash is not None else None,
+                 category, match["message_id"] if match else None, time.time(),
+                 fingerprint.attachment_key, fingerprint.po_key)
+            )
+            self.conn.commit()
+            if match is None and fingerprint.simhash is not None:
+                self._remember(message_id, fingerprint, category)
+            return match
+
+    def lookup(self, message_id, fingerprint):
+        """Like check(), but read-only: a message not seen before is not indexed."""
+        with self.lock:
+            recorded, original = self._recorded(message_id)
+            if recorded:
+                return original
+            return self._nearest(fingerprint)
+
+    def set_category(self, message_id, category):
+        """Records the category of an original once it is classified, for its later duplicates."""
+        with self.lock:
+            if message_id in self.entries:
+                self.entries[message_id] = (self.entries[message_id][0], category) + self.entries[message_id][2:]
+            self.conn.execute("UPDATE fingerprints SET category = ? WHERE message_id = ?", (category, message_id))
+            self.conn.commit()
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def get_duplicate_index():
+    """Shared index for the process, so sorter threads and mailboxes see each other's mail."""
+    global _index
+    with _index_lock:
+        if _index is None:
+            _index = DuplicateIndex()
+    return _index
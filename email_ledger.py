@@ -0,0 +1,132 @@
+import os
+import sqlite3
+import time
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Local SQLite ledger recording how far each message got through the sorter,
+# so a crashed or repeated run never classifies, logs or moves a message twice.
+EMAIL_LEDGER_PATH = os.getenv("EMAIL_LEDGER_PATH", "email_ledger.db")
+
+STAGE_FETCHED = "fetched"
+STAGE_CLASSIFIED = "classified"
+STAGE_LOGGED = "logged"
+STAGE_MOVED = "moved"
+
+# Stages are strictly ordered; a message's rank is the last stage it completed.
+STAGE_RANKS = {
+    STAGE_FETCHED: 1,
+    STAGE_CLASSIFIED: 2,
+    STAGE_LOGGED: 3,
+    STAGE_MOVED: 4,
+}
+
+
+class EmailLedger:
+    """
+    Records the last completed pipeline stage per message.
+    Messages are keyed by mailbox and Graph message id, and also indexed by internetMessageId,
+    which survives a move (Graph assigns a new id to the moved copy). The internetMessageId is
+    the same in every mailbox a message was sent to, so lookups by it are scoped to the mailbox
+    too. `mailbox` None means the default mailbox, as in the mutation queue.
+    """
+
+    def __init__(self, path=EMAIL_LEDGER_PATH):
+        self.path = path
+        self.conn = sqlite3.connect(path)
+        self.conn.row_factory = sqlite3.Row
+        columns = {row["name"] for row in self.conn.execute("PRAGMA table_info(messages)")}
+        unscoped = bool(columns) and "mailbox" not in columns
+        if unscoped:
+            self.conn.execute("BEGIN")  # the rebuild below commits as one transaction
+            self.conn.execute("DROP INDEX IF EXISTS idx_messages_internet_id")
+            self.conn.execute("ALTER TABLE messages RENAME TO messages_unscoped")
+        self.conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS messages (
+                mailbox TEXT NOT NULL DEFAULT '',
+                message_id TEXT NOT NULL,
+                internet_message_id TEXT,
+                stage TEXT NOT NULL,
+                stage_rank INTEGER NOT NULL,
+                category TEXT,
+                from_email TEXT,
+                subject TEXT,
+                decided_by TEXT,
+                updated_at REAL NOT NULL,
+                PRIMARY KEY (mailbox, message_id)
+            )
+            """
+        )
+        if unscoped:
+            self._copy_unscoped_rows(columns)
+        self.conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_messages_mailbox_internet_id ON messages (mailbox, internet_message_id)"
+        )
+        self.conn.commit()
+
+    def _copy_unscoped_rows(self, columns):
+        # Ledgers from before mailbox scoping were keyed by message id alone; their rows
+        # belong to the default mailbox, the only one sorted back then.
+        decided_by = "decided_by" if "decided_by" in columns else "NULL"
+        self.conn.execute(
+            f"""
+            INSERT INTO messages (mailbox, message_id, internet_message_id, stage, stage_rank, category, from_email,
+                                  subject, decided_by, updated_at)
+            SELECT '', message_id, internet_message_id, stage, stage_rank, category, from_email,
+                   subject, {decided_by}, updated_at FROM messages_unscoped
+            """
+        )
+        self.conn.execute("DROP TABLE messages_unscoped")
+
+    def get(self, message_id, internet_message_id=None, mailbox=None):
+        """Returns the ledger entry for a message as a dict, or None if it has never been seen."""
+        row = self.conn.execute(
+            "SELECT * FROM messages WHERE mailbox = ? AND message_id = ?", (mailbox or "", message_id)
+        ).fetchone()
+        if row is None and internet_message_id:
+            row = self.conn.execute(
+                "SELECT * FROM messages WHERE mailbox = ? AND internet_message_id = ? ORDER BY stage_rank DESC LIMIT 1",
+                (mailbox or "", internet_message_id)
+            ).fetchone()
+        return dict(row) if row else None
+
+    def stage_rank(self, message_id, internet_message_id=None, mailbox=None):
+        """Returns the rank of the last completed stage (0 if the message is unknown)."""
+        entry = self.get(message_id, internet_message_id, mailbox=mailbox)
+        return entry["stage_rank"] if entry else 0
+
+    def is_complete(self, message_id, internet_message_id=None, mailbox=None):
+        return self.stage_rank(message_id, internet_message_id, mailbox=mailbox) >= STAGE_RANKS[STAGE_MOVED]
+
+    def record_stage(self, message_id, stage, internet_message_id=None, category=None, from_email=None, subject=None,
+                     decided_by=None, mailbox=None):
+        """
+        Marks `stage` as completed for a message. A stage never moves backwards,
+        and fields passed as None keep their previously recorded values.
+        `decided_by` says what chose the category (classifier, sender_prior, thread, ...).
+        """
+        rank = STAGE_RANKS[stage]
+        self.conn.execute(
+            """
+            INSERT INTO messages (mailbox, message_id, internet_message_id, stage, stage_rank, category, from_email,
+                                  subject, decided_by, updated_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT(mailbox, message_id) DO UPDATE SET
+                internet_message_id = COALESCE(excluded.internet_message_id, messages.internet_message_id),
+                stage = CASE WHEN excluded.stage_rank > messages.stage_rank THEN excluded.stage ELSE messages.stage END,
+                stage_rank = MAX(excluded.stage_rank, messages.stage_rank),
+                category = COALESCE(excluded.category, messages.category),
+                from_email = COALESCE(excluded.from_email, messages.from_email),
+                subject = COALESCE(excluded.subject, messages.subject),
+                decided_by = COALESCE(excluded.decided_by, messages.decided_by),
+                updated_at = excluded.updated_at
+            """,
+            (mailbox or "", message_id, internet_message_id, stage, rank, category, from_email, subject, decided_by,
+             time.time())
+        )
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
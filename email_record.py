@@ -0,0 +1,126 @@
+import argparse
+import sys
+import tracemalloc
+from dataclasses import dataclass
+
+# Attachment metadata fields kept on a record; everything else Graph returns is dropped.
+ATTACHMENT_KEYS = ("id", "name", "contentType", "size")
+
+
+def _intern(value):
+    return sys.intern(value) if value else ""
+
+
+@dataclass(slots=True, eq=False)
+class EmailRecord:
+    """
+    Compact view of a Graph message used throughout the sorting pipeline.
+    Sender address and domain are interned (the same few hundred customers send most
+    mail), and the body can be released once it has been classified and logged;
+    reading `body` afterwards fetches it again through `body_loader`.
+    """
+
+    id: str
+    subject: str = ""
+    sender: str = ""
+    sender_name: str = ""
+    domain: str = ""
+    internet_message_id: str | None = None
+    conversation_id: str | None = None
+    received: str | None = None
+    has_attachments: bool = False
+    is_read: bool = False
+    attachments: list | None = None  # None when the list call did not $expand attachments
+    mailbox: str | None = None
+    body_preview: str = ""
+    _body: str | None = None
+
+    # Set by graph_helper: callable(message_id, mailbox) -> body content. Class-level so records stay picklable.
+    body_loader = None
+
+    @classmethod
+    def from_graph(cls, data, mailbox=None):
+        """Builds a record from a Graph message dict. Inline attachments are left out."""
+        address_info = (data.get("from") or data.get("sender") or {}).get("emailAddress") or {}
+        sender = (address_info.get("address") or "").lower()
+        attachments = data.get("attachments")
+        if attachments is not None:
+            attachments = [
+                {key: att.get(key) for key in ATTACHMENT_KEYS}
+                for att in attachments if not att.get("isInline", False)
+            ]
+        return cls(
+            id=data.get("id"),
+            subject=data.get("subject") or "",
+            sender=_intern(sender),
+            sender_name=address_info.get("name") or "",
+            domain=_intern(sender.rsplit("@", 1)[1] if "@" in sender else ""),
+            internet_message_id=data.get("internetMessageId"),
+            conversation_id=data.get("conversationId"),
+            received=data.get("receivedDateTime"),
+            has_attachments=bool(data.get("hasAttachments", False)),
+            is_read=bool(data.get("isRead", False)),
+            attachments=attachments,
+            mailbox=_intern(mailbox) if mailbox else None,
+            body_preview=data.get("bodyPreview") or "",
+            _body=(data.get("body") or {}).get("content"),
+        )
+
+    @property
+    def body(self):
+        """Full body content, falling back to the preview. Loaded from Graph if it was released."""
+        if self._body is None and EmailRecord.body_loader is not None:
+            self._body = EmailRecord.body_loader(self.id, self.mailbox) or ""
+        return self._body or self.body_preview
+
+    def release_body(self):
+        """Drops the (often large HTML) body; it is re-fetched on the next access."""
+        self._body = None
+
+
+def measure_peak_memory(n_messages=10_000, body_size=20_000):
+    """Compares peak memory of holding n Graph dicts vs. EmailRecords with released bodies."""
+    html = "<html><body>" + ("Please find attached our purchase order. " * (body_size // 42)) + "</body></html>"
+
+    def graph_message(i):
+        return {
+            "id": f"AAMkAD{i:012d}",
+            "internetMessageId": f"<{i}@mail.example.com>",
+            "conversationId": f"conv-{i // 3}",
+            "subject": f"PO {4500000 + i}",
+            "from": {"emailAddress": {"address": f"buyer{i % 300}@customer{i % 150}.com", "name": "Buyer"}},
+            "sender": {"emailAddress": {"address": f"buyer{i % 300}@customer{i % 150}.com", "name": "Buyer"}},
+            "receivedDateTime": "2026-01-01T00:00:00Z",
+            "hasAttachments": True,
+            "body": {"contentType": "html", "content": html + str(i)},
+            "bodyPreview": "Please find attached our purchase order.",
+            "attachments": [{"@odata.type": "#microsoft.graph.fileAttachment", "id": f"att{i}", "name": "PO.pdf",
+                             "contentType": "application/pdf", "size": 120_000, "isInline": False}],
+        }
+
+    tracemalloc.start()
+    kept_dicts = [graph_message(i) for i in range(n_messages)]
+    _, dict_peak = tracemalloc.get_traced_memory()
+    del kept_dicts
+    tracemalloc.stop()
+
+    tracemalloc.start()
+    records = []
+    for i in range(n_messages):
+        record = EmailRecord.from_graph(graph_message(i))
+        record.release_body()  # what process_emails does once a message is classified and logged
+        records.append(record)
+    _, record_peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    print(f"Peak memory for {n_messages} messages (~{body_size // 1000} KB bodies):")
+    print(f"  raw Graph dicts kept:          {dict_peak / 1024 / 1024:8.1f} MiB")
+    print(f"  EmailRecords, bodies released: {record_peak / 1024 / 1024:8.1f} MiB")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure EmailRecord memory use.")
+    parser.add_argument("--messages", type=int, default=10_000)
+    parser.add_argument("--body-size", type=int, default=20_000)
+    args = parser.parse_args()
+    measure_peak_memory(args.messages, args.body_size)
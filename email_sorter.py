@@ -1,14 +1,23 @@
-from airtable_logger import log_email_to_airtable
+from airtable_logger import log_email_record_to_airtable
+from email_ledger import EmailLedger, STAGE_RANKS, STAGE_FETCHED, STAGE_CLASSIFIED, STAGE_LOGGED, STAGE_MOVED
+from sender_index import SenderPriorIndex
+from email_record import EmailRecord
+from mutation_queue import ACTION_MOVE, get_mutation_queue
+from attachment_scanner import ATTACHMENT_SCAN_ENABLED, AttachmentScanCache, find_po_numbers_in_attachments
+from duplicate_detector import email_fingerprint, get_duplicate_index
+from app_logging import get_logger, log_event
+from profiling import profiled, span
 import os
 import re
 import time
 from graph_helper import (
     get_folder_id,
     get_unread_emails,
-    move_email,
     get_email_attachments
 )
 
+logger = get_logger("sorter")
+
 # --- Configuration ---
 FOLDER_NEEDS_ATTENTION = "Needs Attention"
 FOLDER_QUOTE_REQUESTS = "Quote Requests"
@@ -26,6 +35,10 @@ QUOTE_SUBJECT_BODY_KEYWORDS = [
 ]
 SPEC_SHEET_ATTACHMENT_KEYWORDS = ["spec", "specification", "datasheet", "drawing"]
 
+def has_body_po_signal(body):
+    """True when a lower-cased body mentions a purchase order or a PO number."""
+    return "po#" in body or "purchase order" in body or len(re.findall(r"\bpo\s?[0-9]{4,10}\b", body)) > 0
+
 def detect_purchase_order_signals(subject, body, attachments):
     score = 0
     subject = subject.lower()
@@ -34,23 +47,23 @@ def detect_purchase_order_signals(subject, body, attachments):
 
     if any(name.endswith(".pdf") for name in filenames):
         score += 1
-    if "po#" in body or "purchase order" in body or len(re.findall(r"\bpo\s?[0-9]{4,10}\b", body)) > 0:
+    if has_body_po_signal(body):
         score += 1
     if any("po" in name or re.search(r"\d{4,}", name) for name in filenames):
         score += 1
 
     return score >= 2
 
+@profiled("sorter.categorize")
 def categorize_email(email_data, attachments):
-    subject_original = email_data.get('subject', '')
+    if isinstance(email_data, dict):
+        email_data = EmailRecord.from_graph(email_data)
+    subject_original = email_data.subject
     subject_lower = subject_original.lower()
 
-    body_content_data = email_data.get('body', {})
-    body_content = body_content_data.get('content', '').lower() if body_content_data else ''
-    if not body_content:
-        body_content = email_data.get('bodyPreview', '').lower()
+    body_content = email_data.body.lower()
 
-    has_attachments_flag = email_data.get('hasAttachments', False)
+    has_attachments_flag = email_data.has_attachments
     content_to_search = subject_lower + " " + body_content
 
     is_po_pdf_present = False
@@ -81,7 +94,7 @@ def categorize_email(email_data, attachments):
             if subject_lower.startswith("fw:") or subject_lower.startswith("fwd:"):
                 return FOLDER_PURCHASE_ORDERS
         else:
-            print("Spec sheet present; skipping PO classification.")
+            logger.debug("Spec sheet present; skipping PO classification.")
 
     if detect_purchase_order_signals(subject_original, body_content, attachments):
         return FOLDER_PURCHASE_ORDERS
@@ -95,66 +108,205 @@ def categorize_email(email_data, attachments):
 
     return FOLDER_NEEDS_ATTENTION
 
+def email_attachments(email, mailbox=None):
+    """Non-inline attachments of a listed email, using $expand'ed metadata when the list call included it."""
+    if not email.has_attachments:
+        return []
+    if email.attachments is not None:
+        return email.attachments
+    return get_email_attachments(email.id, mailbox=mailbox)
+
+def get_target_folder_ids(inbox_id="inbox", mailbox=None):
+    """Looks up the IDs of the three sorting folders under the Inbox."""
+    return {
+        FOLDER_NEEDS_ATTENTION: get_folder_id(FOLDER_NEEDS_ATTENTION, parent_folder_id=inbox_id, mailbox=mailbox),
+        FOLDER_QUOTE_REQUESTS: get_folder_id(FOLDER_QUOTE_REQUESTS, parent_folder_id=inbox_id, mailbox=mailbox),
+        FOLDER_PURCHASE_ORDERS: get_folder_id(FOLDER_PURCHASE_ORDERS, parent_folder_id=inbox_id, mailbox=mailbox)
+    }
+
 # ✅ Wrapper function required for import
-def process_emails():
+@profiled("sorter.process_emails")
+def process_emails(emails=None, folder_ids=None, mailbox=None):
+    """
+    Classifies and logs unread Inbox emails and queues their moves; the moves are
+    applied in the background by the mutation executor (see mutation_queue.py).
+    Pass `emails` (EmailRecords) to sort a specific set instead, e.g. messages
+    reported by change notifications; otherwise the latest unread emails are fetched.
+    Long-running callers can pass cached `folder_ids` from get_target_folder_ids().
+    `mailbox` defaults to SHARED_MAILBOX_ADDRESS.
+    """
     processed_email_summaries = []
 
     inbox_id = "inbox"  # You could refactor this if needed
 
-    folder_ids = {
-        FOLDER_NEEDS_ATTENTION: get_folder_id(FOLDER_NEEDS_ATTENTION, parent_folder_id=inbox_id),
-        FOLDER_QUOTE_REQUESTS: get_folder_id(FOLDER_QUOTE_REQUESTS, parent_folder_id=inbox_id),
-        FOLDER_PURCHASE_ORDERS: get_folder_id(FOLDER_PURCHASE_ORDERS, parent_folder_id=inbox_id)
-    }
+    if folder_ids is None:
+        folder_ids = get_target_folder_ids(inbox_id, mailbox=mailbox)
 
     if not all(folder_ids.values()):
-        print("Exiting due to missing target folder(s).")
+        logger.error("Exiting due to missing target folder(s).")
         return processed_email_summaries
 
-    unread_emails = get_unread_emails(folder_id=inbox_id, top_n=20)
+    if emails is None:
+        unread_emails = get_unread_emails(folder_id=inbox_id, top_n=20, expand_attachments=True, mailbox=mailbox)
+    else:
+        unread_emails = emails
 
     if not unread_emails:
-        print("No unread emails to process.")
+        logger.info("No unread emails to process.")
         return processed_email_summaries
 
+    ledger = EmailLedger()
+    mutations = get_mutation_queue()
+    sender_index = SenderPriorIndex()
+    duplicates = get_duplicate_index()
+    prior_hits = 0
+    duplicate_hits = 0
+    scan_cache = AttachmentScanCache() if ATTACHMENT_SCAN_ENABLED else None
+    classifications_saved = 0
+    moves_queued = 0
+
+    # Group the batch by thread so a reply chain is classified once, not once per reply.
+    threads = {}
     for email in unread_emails:
-        email_id = email.get('id')
-        subject = email.get('subject', '')
-        from_email = email.get('from', {}).get('emailAddress', {}).get('address', '')
-        attachments = get_email_attachments(email_id) if email.get('hasAttachments') else []
-
-        body = email.get('body', {}).get('content') or email.get('bodyPreview', '')
-
-        category = categorize_email(email, attachments)
-
-        log_email_to_airtable(
-            email_id=email_id,
-            from_email=from_email,
-            email_subject=subject,
-            email_content=body,
-            email_attachments=attachments,
-            attachments_names=[att.get('name', '') for att in attachments],
-            attachments_types=[att.get('contentType', '') for att in attachments],
-            po_detected=(category == FOLDER_PURCHASE_ORDERS),
-            category=category,
-            status="Sorted",
-            reply_sent="No",
-            notes=""
-        )
-
-        dest_folder_id = folder_ids.get(category)
-        if dest_folder_id:
-            print(f"Moving email ID {email_id} to '{category}'")
-            move_email(email_id, dest_folder_id)
-        else:
-            print(f"No destination folder ID found for '{category}'")
+        threads.setdefault(email.conversation_id or email.id, []).append(email)
+
+    for conversation_id, thread_emails in threads.items():
+        # Oldest first: the message that started the thread decides it, replies inherit.
+        thread_emails.sort(key=lambda email: email.received or "")
+        thread_category = None
+        thread_attachment_names = set()
+
+        for email in thread_emails:
+            started = time.perf_counter()
+            email_id = email.id
+            duplicate_of = None
+            internet_message_id = email.internet_message_id
+            subject = email.subject
+            from_email = email.sender
+
+            # Resume from the last stage this message completed in an earlier run.
+            entry = ledger.get(email_id, internet_message_id, mailbox=mailbox)
+            completed_rank = entry["stage_rank"] if entry else 0
+            if completed_rank >= STAGE_RANKS[STAGE_MOVED]:
+                logger.debug(f"Skipping email ID {email_id}: already sorted in a previous run.")
+                continue
+            if mutations.is_pending(email_id, ACTION_MOVE, mailbox=mailbox):
+                logger.debug(f"Skipping email ID {email_id}: its move is still queued.")
+                continue
+            if not entry:
+                ledger.record_stage(email_id, STAGE_FETCHED, internet_message_id=internet_message_id,
+                                    from_email=from_email, subject=subject, mailbox=mailbox)
+
+            attachments = email_attachments(email, mailbox=mailbox)
+            attachment_names = {att.get('name', '').lower() for att in attachments}
+            has_new_attachments = bool(attachment_names - thread_attachment_names)
+            thread_attachment_names |= attachment_names
+
+            if completed_rank >= STAGE_RANKS[STAGE_CLASSIFIED] and entry.get("category"):
+                category = entry["category"]
+                decided_by = "ledger"
+                logger.debug(f"Reusing recorded category '{category}' for email ID {email_id}")
+            elif thread_category and not has_new_attachments and (
+                    thread_category == FOLDER_PURCHASE_ORDERS or not has_body_po_signal(email.body.lower())):
+                # Same thread, nothing new attached or written about a PO: the quoted body was already analysed.
+                category = thread_category
+                decided_by = "thread"
+                classifications_saved += 1
+            else:
+                # Same PO sent twice or CC'd to several mailboxes: route it like the copy already seen.
+                with span("sorter.duplicate_check"):
+                    original = duplicates.check(email_id, email_fingerprint(email, attachments))
+                if original and original["category"]:
+                    category = original["category"]
+                    decided_by = "duplicate"
+                    duplicate_of = original["message_id"]
+                    duplicate_hits += 1
+                    logger.debug(f"Email ID {email_id} is a near-duplicate of {duplicate_of}: using '{category}'")
+                else:
+                    prior_category = sender_index.lookup(from_email)
+                    if (prior_category and prior_category != FOLDER_PURCHASE_ORDERS
+                            and detect_purchase_order_signals(subject, email.body.lower(), attachments)):
+                        # A prior never outranks explicit PO signals in the message itself.
+                        prior_category = None
+                    audit = bool(prior_category) and sender_index.should_audit(email_id)
+                    if prior_category and not audit:
+                        category = prior_category
+                        decided_by = "sender_prior"
+                        prior_hits += 1
+                        logger.debug(f"Known sender {from_email}: using prior category '{category}'")
+                    else:
+                        category = categorize_email(email, attachments)
+                        decided_by = "classifier"
+                        if scan_cache and category != FOLDER_PURCHASE_ORDERS and any(
+                                att.get('contentType', '').lower() == 'application/pdf' for att in attachments):
+                            # File names gave nothing away; look for a PO number inside the PDFs.
+                            if find_po_numbers_in_attachments(email_id, attachments, scan_cache, mailbox=mailbox):
+                                category = FOLDER_PURCHASE_ORDERS
+                                decided_by = "attachment_scan"
+                        if audit and category != prior_category:
+                            logger.info(f"Sender prior for {from_email} said '{prior_category}', classifier said '{category}'")
+                        # Only full classifications feed the index, so priors never reinforce themselves.
+                        sender_index.record(from_email, category)
+                    duplicates.set_category(email_id, category)
+            if completed_rank < STAGE_RANKS[STAGE_CLASSIFIED]:
+                ledger.record_stage(email_id, STAGE_CLASSIFIED, internet_message_id=internet_message_id, category=category,
+                                    decided_by=decided_by, mailbox=mailbox)
+            thread_category = category  # later replies follow the thread's latest decision
+
+            logged = None  # None: already logged in an earlier run, or Airtable is not configured
+            if completed_rank < STAGE_RANKS[STAGE_LOGGED]:
+                logged = log_email_record_to_airtable(
+                    email,
+                    attachments,
+                    category=category,
+                    po_detected=(category == FOLDER_PURCHASE_ORDERS),
+                    status="Sorted",
+                    reply_sent="No",
+                    notes=f"Near-duplicate of {duplicate_of}" if duplicate_of else ""
+                )
+                if logged:
+                    ledger.record_stage(email_id, STAGE_LOGGED, internet_message_id=internet_message_id, mailbox=mailbox)
+
+            # Classified and logged: drop the body so a large batch doesn't keep every HTML body alive.
+            email.release_body()
+
+            # Hand the move to the write-behind queue; classification never waits on mailbox writes.
+            # A message whose Airtable write failed stays in the Inbox: the next run resumes it at
+            # CLASSIFIED and retries the log before moving it. Without Airtable, moves go ahead.
+            dest_folder_id = folder_ids.get(category)
+            move_queued = False
+            if logged is False:
+                logger.warning(f"Airtable logging failed for email ID {email_id}; holding its move until it is logged.")
+            elif dest_folder_id:
+                move_queued = mutations.enqueue(ACTION_MOVE, email_id, argument=dest_folder_id, mailbox=mailbox,
+                                                internet_message_id=internet_message_id)
+                if move_queued:
+                    moves_queued += 1
+                else:
+                    logger.warning(f"Move of email ID {email_id} failed earlier; see `python mutation_queue.py report`.")
+            else:
+                logger.warning(f"No destination folder ID found for '{category}'")
+
+            processed_email_summaries.append({
+                "id": email_id,
+                "subject": subject,
+                "category": category,
+                "conversation_id": conversation_id
+            })
+            log_event(logger, "email_processed", id=email_id, conversation_id=conversation_id, mailbox=mailbox,
+                      category=category, decided_by=decided_by, duplicate_of=duplicate_of, airtable_logged=logged, move_queued=move_queued,
+                      elapsed_ms=round((time.perf_counter() - started) * 1000, 1))
 
-        processed_email_summaries.append({
-            "id": email_id,
-            "subject": subject,
-            "category": category
-        })
 
-    print("Email processing finished.")
+    ledger.close()
+    sender_index.close()
+    if duplicate_hits:
+        logger.info(f"Routed {duplicate_hits} near-duplicate emails like their earlier copies.")
+    if prior_hits:
+        logger.info(f"Sender prior index decided {prior_hits} of {len(unread_emails)} emails.")
+    logger.info(f"Grouped {len(unread_emails)} emails into {len(threads)} conversations; "
+          f"{classifications_saved} classifications saved.")
+    logger.info(f"Queued {moves_queued} move(s) for the mutation executor.")
+    logger.info("Email processing finished.")
     return processed_email_summaries
 
@@ -5,7 +5,13 @@ import json
 # Imports
 from graph_helper import get_email_details as fetch_real_email_details
 from email_request import send_email_update
+from airtable_logger import update_email_status
 from email_sorter import process_emails  # This must be defined in email_sorter.py
+from mutation_queue import get_mutation_executor
+from app_logging import get_logger
+from profiling import profiled
+
+logger = get_logger("tools")
 
 
 # --- Email Sorting Tool ---
@@ -19,15 +25,18 @@ class EmailSorterTool(BaseTool):
     description: str = "Sorts and categorizes unread Outlook emails using Microsoft Graph. No arguments required."
     args_schema: type[BaseModel] = EmailSorterToolSchema
 
+    @profiled("crew.tool.sort_emails")
     def _run(self) -> str:
-        print(f"[{self.name}] Starting tool execution.")
+        logger.info(f"[{self.name}] Starting tool execution.")
         results = process_emails()
+        # Later crew tasks look for emails in the sorted folders, so wait for the queued moves.
+        get_mutation_executor().drain()
         if results is None:
             return "❌ Email sorting failed due to a critical setup error."
         elif not results:
             return "✅ Email sorting complete. No unread emails found."
         else:
-            print(f"[{self.name}] Processed {len(results)} emails.")
+            logger.info(f"[{self.name}] Processed {len(results)} emails.")
             return f"✅ Email sorting complete. Processed {len(results)} emails."
 
 
@@ -42,31 +51,32 @@ class GetEmailDetailsTool(BaseTool):
     description: str = "Fetches sender, subject, body, and metadata for a given email message ID."
     args_schema: type[BaseModel] = GetEmailDetailsToolSchema
 
+    @profiled("crew.tool.get_email_details")
     def _run(self, message_id: str) -> str:
-        print(f"[{self.name}] Fetching email details for ID: {message_id}")
+        logger.info(f"[{self.name}] Fetching email details for ID: {message_id}")
         try:
             email_details_data = fetch_real_email_details(message_id=message_id)
 
             if not email_details_data:
                 error_message = f"Could not retrieve email ID '{message_id}'. It may not exist or an API error occurred."
-                print(f"[{self.name}] {error_message}")
+                logger.warning(f"[{self.name}] {error_message}")
                 return json.dumps({"error": error_message})
 
             output_data = {
-                "original_message_id": email_details_data.get("id"),
-                "original_subject": email_details_data.get("subject"),
-                "full_original_body": email_details_data.get("consolidated_body"),
-                "reply_to_address": email_details_data.get("reply_to_address"),
-                "original_from_name": email_details_data.get("from_name"),
-                "original_from_address": email_details_data.get("from_address")
+                "original_message_id": email_details_data.id,
+                "original_subject": email_details_data.subject,
+                "full_original_body": email_details_data.body,
+                "reply_to_address": email_details_data.sender,
+                "original_from_name": email_details_data.sender_name or "N/A",
+                "original_from_address": email_details_data.sender
             }
 
-            print(f"[{self.name}] Success. Returning email details.")
+            logger.info(f"[{self.name}] Success. Returning email details.")
             return json.dumps(output_data)
 
         except Exception as e:
             error_str = f"Error in {self.name}: {str(e)}"
-            print(f"[{self.name}] {error_str}")
+            logger.error(f"[{self.name}] {error_str}")
             return json.dumps({"error": error_str, "message_id": message_id})
 
 
@@ -84,8 +94,9 @@ class DraftAndLogEmailTool(BaseTool):
     description: str = "Simulates sending a drafted email and logs the draft output."
     args_schema: type[BaseModel] = DraftAndLogEmailToolSchema
 
+    @profiled("crew.tool.draft_and_log")
     def _run(self, original_message_id: str, recipient_email: str, draft_subject: str, draft_body: str) -> str:
-        print(f"[{self.name}] Preparing to send draft to {recipient_email} with subject: {draft_subject}")
+        logger.info(f"[{self.name}] Preparing to send draft to {recipient_email} with subject: {draft_subject}")
         try:
             if not all([original_message_id, recipient_email, draft_subject, draft_body]):
                 return json.dumps({
@@ -107,11 +118,16 @@ class DraftAndLogEmailTool(BaseTool):
                 "confirmation_from_send_email_update": confirmation_message
             }
 
-            print(f"[{self.name}] Success. Logging output.")
+            # Single PATCH against the existing row via the local Email_ID index.
+            log_output["airtable_status_updated"] = update_email_status(
+                original_message_id, status="Draft Prepared", reply_sent=True
+            )
+
+            logger.info(f"[{self.name}] Success. Logging output.")
             return json.dumps(log_output)
 
         except Exception as e:
             error_str = f"Failed to process/log draft email: {str(e)}"
-            print(f"[{self.name}] {error_str}")
+            logger.error(f"[{self.name}] {error_str}")
             return json.dumps({"error": error_str})
 
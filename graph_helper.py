@@ -2,31 +2,67 @@ import os
 import requests
 import json
 from auth import get_access_token  # To get the token from our auth.py
+from email_record import EmailRecord
+from app_logging import get_logger
+from profiling import profiled, span
 from dotenv import load_dotenv
 
+try:
+    import orjson  # optional: decodes large message pages several times faster than json
+except ImportError:
+    orjson = None
+try:
+    import ijson  # optional: incremental parsing, so list pages are handled one message at a time
+except ImportError:
+    ijson = None
+
 load_dotenv()  # ✅ This tells Python to load variables from .env
 
+logger = get_logger("graph")
+
 GRAPH_API_ENDPOINT = "https://graph.microsoft.com/v1.0"
 SHARED_MAILBOX_ADDRESS = os.getenv("SHARED_MAILBOX_ADDRESS")  # ✅ Fixed
+# Every mailbox function takes an optional `mailbox`; SHARED_MAILBOX_ADDRESS is only the default.
+# Multi-mailbox runs (mailbox_supervisor.py) list their mailboxes in SORTER_MAILBOXES instead.
+SORTER_MAILBOXES = os.getenv("SORTER_MAILBOXES")
 
-if not SHARED_MAILBOX_ADDRESS:
-    print("CRITICAL ERROR: SHARED_MAILBOX_ADDRESS is not set in your .env file.")
-    print('Please add SHARED_MAILBOX_ADDRESS="your_shared_mailbox@example.com" to .env')
+if not SHARED_MAILBOX_ADDRESS and not SORTER_MAILBOXES:
+    logger.critical("CRITICAL ERROR: SHARED_MAILBOX_ADDRESS is not set in your .env file.")
+    logger.critical('Please add SHARED_MAILBOX_ADDRESS="your_shared_mailbox@example.com" to .env')
     exit()
 
+# List endpoints are parsed incrementally when ijson is installed; set to "false" to always
+# decode whole pages (e.g. to compare memory use).
+GRAPH_STREAMING_PARSE = os.getenv("GRAPH_STREAMING_PARSE", "true").lower() == "true"
 
-def make_graph_api_call(method, url_suffix, data=None, params=None, extra_headers=None):
-    """Helper function to make calls to Microsoft Graph API."""
-    token = get_access_token()
+
+def decode_json(content):
+    """Decodes a JSON response body with orjson when it is installed, else the standard library."""
+    return orjson.loads(content) if orjson else json.loads(content)
+
+def _graph_headers(extra_headers=None):
     headers = {
-        "Authorization": f"Bearer {token}",
+        "Authorization": f"Bearer {get_access_token()}",
         "Content-Type": "application/json"
     }
     if extra_headers:
         headers.update(extra_headers)
+    return headers
+
+def _log_http_error(e):
+    logger.error(f"HTTP Error calling Graph API: {e.response.status_code} {e.response.reason}")
+    try:
+        logger.error(f"Error details: {e.response.json()}")
+    except json.JSONDecodeError:
+        logger.error(f"Error details (non-JSON): {e.response.text}")
+
+@profiled("graph.request")
+def make_graph_api_call(method, url_suffix, data=None, params=None, extra_headers=None):
+    """Helper function to make calls to Microsoft Graph API."""
+    headers = _graph_headers(extra_headers)
 
     full_url = f"{GRAPH_API_ENDPOINT}{url_suffix}"
-    # print(f"DEBUG: Calling Graph API: {method} {full_url} Params: {params} Data: {data}") # Optional debug
+    logger.debug(f"Calling Graph API: {method} {full_url} Params: {params}")
 
     try:
         if method.upper() == "GET":
@@ -40,44 +76,79 @@ def make_graph_api_call(method, url_suffix, data=None, params=None, extra_header
         else:
             raise ValueError(f"Unsupported HTTP method: {method}")
 
-        # print(f"DEBUG: Response Status: {response.status_code}") # Optional debug
-        # if response.content:
-        #     try:
-        #         print(f"DEBUG: Response JSON: {response.json()}") # Optional debug
-        #     except json.JSONDecodeError:
-        #         print(f"DEBUG: Response Text: {response.text}") # Optional debug
+        logger.debug(f"Response Status: {response.status_code} ({len(response.content)} bytes)")
 
         response.raise_for_status() 
         if response.status_code == 204: # No Content
             return None
         if response.content:
-             return response.json()
+             return decode_json(response.content)
         return None 
     except requests.exceptions.HTTPError as e:
-        print(f"HTTP Error calling Graph API: {e.response.status_code} {e.response.reason}")
-        try:
-            print(f"Error details: {e.response.json()}")
-        except json.JSONDecodeError:
-            print(f"Error details (non-JSON): {e.response.text}")
+        _log_http_error(e)
+        raise
+    except Exception as e:
+        logger.error(f"Error calling Graph API endpoint {url_suffix}: {e}")
+        raise
+
+def _iter_value_items(stream, links):
+    """Yields each object of a response's "value" array as soon as it has been parsed."""
+    builder = None
+    for prefix, event, value in ijson.parse(stream, use_float=True):
+        if builder is None and prefix == "value.item" and event == "start_map":
+            builder = ijson.ObjectBuilder()
+        if builder is not None:
+            builder.event(event, value)
+            if prefix == "value.item" and event == "end_map":
+                yield builder.value
+                builder = None
+        elif prefix in ("@odata.nextLink", "@odata.deltaLink"):
+            links[prefix] = value
+
+def iter_graph_list(url_suffix, params=None, links=None):
+    """
+    GETs one page of a Graph list endpoint and yields the items of its "value" array.
+    With ijson installed (and GRAPH_STREAMING_PARSE on) items are parsed straight off the
+    socket, so the first message is available before the page has finished downloading and
+    the raw page is never held in memory as a whole. `links`, if given, receives the page's
+    "@odata.nextLink" / "@odata.deltaLink" once the generator is exhausted.
+    """
+    links = {} if links is None else links
+    if not (ijson and GRAPH_STREAMING_PARSE):
+        response = make_graph_api_call("GET", url_suffix, params=params) or {}
+        for key in ("@odata.nextLink", "@odata.deltaLink"):
+            if key in response:
+                links[key] = response[key]
+        yield from response.get("value", [])
+        return
+
+    try:
+        with requests.get(f"{GRAPH_API_ENDPOINT}{url_suffix}", headers=_graph_headers(), params=params, stream=True) as response:
+            response.raise_for_status()
+            response.raw.decode_content = True  # let urllib3 undo gzip before ijson sees the bytes
+            yield from _iter_value_items(response.raw, links)
+    except requests.exceptions.HTTPError as e:
+        _log_http_error(e)
         raise
     except Exception as e:
-        print(f"Error calling Graph API endpoint {url_suffix}: {e}")
+        logger.error(f"Error streaming Graph API endpoint {url_suffix}: {e}")
         raise
 
-def get_folder_id(folder_name, parent_folder_id=None):
+def get_folder_id(folder_name, parent_folder_id=None, mailbox=None):
     """
     Gets the ID of a folder.
     If parent_folder_id is provided, searches within that folder.
     Otherwise, searches at the root of the shared mailbox.
     Case-sensitive for folder_name.
     """
-    print(f"Attempting to get ID for folder: '{folder_name}' in mailbox '{SHARED_MAILBOX_ADDRESS}'")
+    mailbox = mailbox or SHARED_MAILBOX_ADDRESS
+    logger.debug(f"Attempting to get ID for folder: '{folder_name}' in mailbox '{mailbox}'")
     if parent_folder_id:
-        print(f"Searching within parent folder ID: {parent_folder_id}")
-        url_suffix = f"/users/{SHARED_MAILBOX_ADDRESS}/mailFolders/{parent_folder_id}/childFolders"
+        logger.debug(f"Searching within parent folder ID: {parent_folder_id}")
+        url_suffix = f"/users/{mailbox}/mailFolders/{parent_folder_id}/childFolders"
     else:
-        print("Searching at mailbox root.")
-        url_suffix = f"/users/{SHARED_MAILBOX_ADDRESS}/mailFolders"
+        logger.debug("Searching at mailbox root.")
+        url_suffix = f"/users/{mailbox}/mailFolders"
     
     params = {"$filter": f"displayName eq '{folder_name}'", "$select": "id,displayName"}
     
@@ -86,74 +157,133 @@ def get_folder_id(folder_name, parent_folder_id=None):
         if response and response.get("value"):
             if len(response["value"]) == 1:
                 folder_id = response["value"][0]["id"]
-                print(f"Found folder '{folder_name}' with ID: {folder_id}")
+                logger.debug(f"Found folder '{folder_name}' with ID: {folder_id}")
                 return folder_id
             elif len(response["value"]) > 1:
-                print(f"Warning: Multiple folders found with the name '{folder_name}' under the specified parent. Using the first one.")
+                logger.warning(f"Warning: Multiple folders found with the name '{folder_name}' under the specified parent. Using the first one.")
                 folder_id = response["value"][0]["id"]
-                print(f"Using ID: {folder_id} for folder '{folder_name}'")
+                logger.debug(f"Using ID: {folder_id} for folder '{folder_name}'")
                 return folder_id
             else:
                 search_location = f"under parent ID {parent_folder_id}" if parent_folder_id else "at mailbox root"
-                print(f"Folder '{folder_name}' not found {search_location} in mailbox '{SHARED_MAILBOX_ADDRESS}'.")
+                logger.warning(f"Folder '{folder_name}' not found {search_location} in mailbox '{mailbox}'.")
                 return None
         else:
             search_location = f"under parent ID {parent_folder_id}" if parent_folder_id else "at mailbox root"
-            print(f"No 'value' in response or empty response when searching for folder '{folder_name}' {search_location}. Response: {response}")
+            logger.warning(f"No 'value' in response or empty response when searching for folder '{folder_name}' {search_location}. Response: {response}")
             return None
     except Exception as e:
         # Catching exception here so one folder failing doesn't stop everything if called in a loop
-        print(f"Error getting folder ID for '{folder_name}': {e}")
+        logger.error(f"Error getting folder ID for '{folder_name}': {e}")
         return None
 
-def get_unread_emails(folder_id="inbox", top_n=10):
-    """Gets the top N unread emails from a specified folder (default is inbox)."""
+ATTACHMENT_SELECT_FIELDS = "id,name,contentType,size,isInline"
+MESSAGE_SELECT_FIELDS = "id,internetMessageId,subject,from,sender,receivedDateTime,body,bodyPreview,hasAttachments,conversationId"
+DELTA_SELECT_FIELDS = "id,isRead"
+
+def _expanded_message_params(expand_attachments):
+    params = {"$select": MESSAGE_SELECT_FIELDS}
+    if expand_attachments:
+        params["$expand"] = f"attachments($select={ATTACHMENT_SELECT_FIELDS})"
+    return params
+
+def iter_unread_emails(folder_id="inbox", top_n=10, expand_attachments=False, mailbox=None):
+    """
+    Yields the top N unread emails from a specified folder (default is inbox) as EmailRecords,
+    one at a time as the page is parsed. With expand_attachments=True, attachment metadata is
+    returned in the same page via $expand and stored on each record's `attachments` (inline
+    attachments removed), so callers don't need a get_email_attachments call per message.
+    """
+    mailbox = mailbox or SHARED_MAILBOX_ADDRESS
     folder_to_query = folder_id 
     if folder_id.lower() == "inbox":
-         print(f"Fetching unread emails from Inbox of {SHARED_MAILBOX_ADDRESS}...")
-         url_suffix = f"/users/{SHARED_MAILBOX_ADDRESS}/mailFolders/inbox/messages"
+         logger.debug(f"Fetching unread emails from Inbox of {mailbox}...")
+         url_suffix = f"/users/{mailbox}/mailFolders/inbox/messages"
     else:
-        print(f"Fetching unread emails from folder ID {folder_id} of {SHARED_MAILBOX_ADDRESS}...")
-        url_suffix = f"/users/{SHARED_MAILBOX_ADDRESS}/mailFolders/{folder_id}/messages"
+        logger.debug(f"Fetching unread emails from folder ID {folder_id} of {mailbox}...")
+        url_suffix = f"/users/{mailbox}/mailFolders/{folder_id}/messages"
 
     params = {
         "$filter": "isRead eq false",
         "$top": top_n,
-        "$select": "id,subject,sender,receivedDateTime,body,bodyPreview,hasAttachments", # body is included
+        "$select": MESSAGE_SELECT_FIELDS, # body is included
         "$orderby": "receivedDateTime desc"
     }
+    params.update(_expanded_message_params(expand_attachments))
+    for email in iter_graph_list(url_suffix, params=params):
+        yield EmailRecord.from_graph(email, mailbox)
+
+def get_unread_emails(folder_id="inbox", top_n=10, expand_attachments=False, mailbox=None):
+    """Gets the top N unread emails from a specified folder as a list of EmailRecords (see iter_unread_emails)."""
     try:
-        response = make_graph_api_call("GET", url_suffix, params=params)
-        if response and "value" in response:
-            print(f"Found {len(response['value'])} unread emails.")
-            return response["value"]
-        print("No unread emails found or error in response.")
-        return []
+        with span("graph.list_unread"):
+            emails = list(iter_unread_emails(folder_id, top_n=top_n, expand_attachments=expand_attachments, mailbox=mailbox))
+        if emails:
+            logger.info(f"Found {len(emails)} unread emails.")
+        else:
+            logger.info("No unread emails found or error in response.")
+        return emails
     except Exception as e:
-        print(f"Error fetching unread emails: {e}")
+        logger.error(f"Error fetching unread emails: {e}")
         return []
 
-def get_email_attachments(message_id):
+def get_folder_messages_page(folder_id="inbox", page_size=50, next_link=None, expand_attachments=True, mailbox=None):
+    """
+    Gets one page of all messages (read or unread) in a folder, oldest first.
+    Returns (EmailRecords, next_link); pass next_link back in to get the following page,
+    it is None after the last page.
+    """
+    mailbox = mailbox or SHARED_MAILBOX_ADDRESS
+    if next_link:
+        url_suffix, params = next_link.replace(GRAPH_API_ENDPOINT, "", 1), None
+    else:
+        url_suffix = f"/users/{mailbox}/mailFolders/{folder_id}/messages"
+        params = {"$top": page_size, "$orderby": "receivedDateTime asc"}
+        params.update(_expanded_message_params(expand_attachments))
+    links = {}
+    with span("graph.list_page"):
+        messages = [EmailRecord.from_graph(email, mailbox) for email in iter_graph_list(url_suffix, params, links)]
+    return messages, links.get("@odata.nextLink")
+
+@profiled("graph.get_attachments")
+def get_email_attachments(message_id, mailbox=None):
     """Fetches attachment details for a specific email, excluding inline attachments."""
-    print(f"  Fetching attachments for message ID {message_id}...")
-    url_suffix = f"/users/{SHARED_MAILBOX_ADDRESS}/messages/{message_id}/attachments"
-    params = {"$select": "id,name,contentType,size,isInline"} 
+    mailbox = mailbox or SHARED_MAILBOX_ADDRESS
+    logger.debug(f"  Fetching attachments for message ID {message_id}...")
+    url_suffix = f"/users/{mailbox}/messages/{message_id}/attachments"
+    params = {"$select": ATTACHMENT_SELECT_FIELDS}
     try:
         response = make_graph_api_call("GET", url_suffix, params=params)
         if response and "value" in response:
             attachments = [att for att in response["value"] if not att.get("isInline", False)]
-            print(f"    Found {len(attachments)} non-inline attachments.")
+            logger.debug(f"    Found {len(attachments)} non-inline attachments.")
             return attachments 
-        print(f"    No attachments found for message ID {message_id} or error in response.")
+        logger.debug(f"    No attachments found for message ID {message_id} or error in response.")
         return []
     except Exception as e:
-        print(f"    Error fetching attachments for message ID {message_id}: {e}")
+        logger.error(f"    Error fetching attachments for message ID {message_id}: {e}")
         return []
 
-def move_email(message_id, destination_folder_id):
+def stream_attachment_content(message_id, attachment_id, chunk_size=64 * 1024, mailbox=None):
+    """
+    Yields the raw bytes of a file attachment ($value) in chunks without loading it all into memory.
+    Stop iterating (or close the generator) to abort the download early.
+    """
+    mailbox = mailbox or SHARED_MAILBOX_ADDRESS
+    token = get_access_token()
+    url = f"{GRAPH_API_ENDPOINT}/users/{mailbox}/messages/{message_id}/attachments/{attachment_id}/$value"
+    with requests.get(url, headers={"Authorization": f"Bearer {token}"}, stream=True) as response:
+        response.raise_for_status()
+        for chunk in response.iter_content(chunk_size=chunk_size):
+            if chunk:
+                yield chunk
+
+
+def move_email(message_id, destination_folder_id, mailbox=None):
     """Moves an email to a specified destination folder."""
-    print(f"Moving message ID {message_id} to folder ID {destination_folder_id} in mailbox {SHARED_MAILBOX_ADDRESS}...")
-    url_suffix = f"/users/{SHARED_MAILBOX_ADDRESS}/messages/{message_id}/move"
+    mailbox = mailbox or SHARED_MAILBOX_ADDRESS
+    logger.debug(f"Moving message ID {message_id} to folder ID {destination_folder_id} in mailbox {mailbox}...")
+    url_suffix = f"/users/{mailbox}/messages/{message_id}/move"
     payload = {
         "destinationId": destination_folder_id
     }
@@ -162,71 +292,223 @@ def move_email(message_id, destination_folder_id):
         # A successful move might return the moved item (201) or just a 200 OK with no body depending on exact API version/behavior for moves.
         # Graph API often returns the moved item.
         if moved_message and moved_message.get("id"):
-             print(f"Successfully moved message ID {message_id} to folder ID {destination_folder_id}.")
+             logger.debug(f"Successfully moved message ID {message_id} to folder ID {destination_folder_id}.")
              return moved_message 
         # If no specific moved_message content but no error, assume success (e.g. 204 No Content is handled by make_graph_api_call returning None)
         # However, 'move' usually returns the item. This part might need adjustment based on observed behavior if 'None' is returned on success.
-        print(f"Message ID {message_id} move action completed. Response: {moved_message}")
+        logger.debug(f"Message ID {message_id} move action completed. Response: {moved_message}")
         return moved_message # Return whatever response we got, could be None for 204 or the item for 201
 
     except Exception as e:
-        print(f"Error moving message ID {message_id}: {e}")
+        logger.error(f"Error moving message ID {message_id}: {e}")
         return None
-def get_email_details(message_id: str) -> dict | None:
+
+GRAPH_BATCH_LIMIT = 20  # Max requests per JSON batch ($batch) call
+
+@profiled("graph.move_batch")
+def move_emails(message_ids, destination_folder_id, mailbox=None):
+    """
+    Moves several emails to the same folder using JSON batching ($batch), 20 moves per request.
+    Returns {message_id: moved_message or None}; None marks a move that failed.
+    """
+    mailbox = mailbox or SHARED_MAILBOX_ADDRESS
+    results = {}
+    for start in range(0, len(message_ids), GRAPH_BATCH_LIMIT):
+        chunk = message_ids[start:start + GRAPH_BATCH_LIMIT]
+        logger.debug(f"Moving {len(chunk)} messages to folder ID {destination_folder_id} in mailbox {mailbox} (batched)...")
+        batch_payload = {
+            "requests": [
+                {
+                    "id": str(i),
+                    "method": "POST",
+                    "url": f"/users/{mailbox}/messages/{message_id}/move",
+                    "body": {"destinationId": destination_folder_id},
+                    "headers": {"Content-Type": "application/json"}
+                }
+                for i, message_id in enumerate(chunk)
+            ]
+        }
+        try:
+            batch_response = make_graph_api_call("POST", "/$batch", data=batch_payload) or {}
+        except Exception as e:
+            logger.error(f"Error in batched move to folder ID {destination_folder_id}: {e}")
+            batch_response = {}
+
+        responses_by_id = {resp.get("id"): resp for resp in batch_response.get("responses", [])}
+        for i, message_id in enumerate(chunk):
+            resp = responses_by_id.get(str(i))
+            if resp and 200 <= resp.get("status", 0) < 300:
+                results[message_id] = resp.get("body") or {}
+            else:
+                logger.warning(f"Failed to move message ID {message_id}: {resp.get('body') if resp else 'no response'}")
+                results[message_id] = None
+    return results
+
+@profiled("graph.update_batch")
+def update_emails(message_ids, changes, mailbox=None):
+    """
+    Applies the same property changes (e.g. {"isRead": True}) to several emails using
+    JSON batching ($batch), 20 PATCH requests per call.
+    Returns {message_id: updated_message or None}; None marks an update that failed.
+    """
+    mailbox = mailbox or SHARED_MAILBOX_ADDRESS
+    results = {}
+    for start in range(0, len(message_ids), GRAPH_BATCH_LIMIT):
+        chunk = message_ids[start:start + GRAPH_BATCH_LIMIT]
+        logger.debug(f"Updating {len(chunk)} messages in mailbox {mailbox} with {changes} (batched)...")
+        batch_payload = {
+            "requests": [
+                {
+                    "id": str(i),
+                    "method": "PATCH",
+                    "url": f"/users/{mailbox}/messages/{message_id}",
+                    "body": changes,
+                    "headers": {"Content-Type": "application/json"}
+                }
+                for i, message_id in enumerate(chunk)
+            ]
+        }
+        try:
+            batch_response = make_graph_api_call("POST", "/$batch", data=batch_payload) or {}
+        except Exception as e:
+            logger.error(f"Error in batched update {changes}: {e}")
+            batch_response = {}
+
+        responses_by_id = {resp.get("id"): resp for resp in batch_response.get("responses", [])}
+        for i, message_id in enumerate(chunk):
+            resp = responses_by_id.get(str(i))
+            if resp and 200 <= resp.get("status", 0) < 300:
+                results[message_id] = resp.get("body") or {}
+            else:
+                logger.warning(f"Failed to update message ID {message_id}: {resp.get('body') if resp else 'no response'}")
+                results[message_id] = None
+    return results
+
+@profiled("graph.get_by_ids")
+def get_emails_by_ids(message_ids, expand_attachments=True, mailbox=None):
+    """
+    Fetches several messages by ID using JSON batching ($batch), 20 per request.
+    Returns EmailRecords for the messages that could be fetched, like get_unread_emails.
+    """
+    mailbox = mailbox or SHARED_MAILBOX_ADDRESS
+    params = _expanded_message_params(expand_attachments)
+    query = "&".join(f"{key}={value}" for key, value in params.items())
+    emails = []
+    for start in range(0, len(message_ids), GRAPH_BATCH_LIMIT):
+        chunk = message_ids[start:start + GRAPH_BATCH_LIMIT]
+        logger.debug(f"Fetching {len(chunk)} messages by ID from {mailbox} (batched)...")
+        batch_payload = {
+            "requests": [
+                {"id": str(i), "method": "GET", "url": f"/users/{mailbox}/messages/{message_id}?{query}"}
+                for i, message_id in enumerate(chunk)
+            ]
+        }
+        try:
+            batch_response = make_graph_api_call("POST", "/$batch", data=batch_payload) or {}
+        except Exception as e:
+            logger.error(f"Error in batched message fetch: {e}")
+            continue
+        for resp in batch_response.get("responses", []):
+            if 200 <= resp.get("status", 0) < 300 and resp.get("body"):
+                emails.append(EmailRecord.from_graph(resp["body"], mailbox))
+            else:
+                logger.warning(f"Failed to fetch message in batch request {resp.get('id')}: status {resp.get('status')}")
+    return emails
+
+@profiled("graph.delta")
+def get_inbox_delta(delta_link=None, mailbox=None):
+    """
+    Runs a delta query on the Inbox messages and returns (new_or_changed EmailRecords, next_delta_link).
+    Pass the delta link from the previous call to get only changes since then; with None,
+    the whole Inbox is enumerated once to establish a baseline.
+    Only ids and read state are selected (the delta link keeps that $select), so the
+    baseline pulls no bodies; fetch the messages to sort with get_emails_by_ids.
+    """
+    mailbox = mailbox or SHARED_MAILBOX_ADDRESS
+    if delta_link:
+        url_suffix, params = delta_link.replace(GRAPH_API_ENDPOINT, "", 1), None
+    else:
+        url_suffix = f"/users/{mailbox}/mailFolders/inbox/messages/delta"
+        params = {"$select": DELTA_SELECT_FIELDS}
+
+    messages = []
+    while True:
+        links = {}
+        messages.extend(EmailRecord.from_graph(msg, mailbox)
+                        for msg in iter_graph_list(url_suffix, params, links) if "@removed" not in msg)
+        if links.get("@odata.nextLink"):
+            url_suffix, params = links["@odata.nextLink"].replace(GRAPH_API_ENDPOINT, "", 1), None
+            continue
+        logger.info(f"Delta query returned {len(messages)} new or changed messages.")
+        return messages, links.get("@odata.deltaLink")
+
+def create_inbox_subscription(notification_url, client_state, expiration_datetime, mailbox=None):
+    """Subscribes to 'created' change notifications on the shared mailbox Inbox. Returns the subscription."""
+    mailbox = mailbox or SHARED_MAILBOX_ADDRESS
+    payload = {
+        "changeType": "created",
+        "notificationUrl": notification_url,
+        "lifecycleNotificationUrl": notification_url,
+        "resource": f"users/{mailbox}/mailFolders('inbox')/messages",
+        "expirationDateTime": expiration_datetime,
+        "clientState": client_state
+    }
+    subscription = make_graph_api_call("POST", "/subscriptions", data=payload)
+    logger.info(f"Created Graph subscription {subscription.get('id')} expiring {subscription.get('expirationDateTime')}.")
+    return subscription
+
+def renew_subscription(subscription_id, expiration_datetime):
+    """Extends an existing Graph subscription. Returns the updated subscription."""
+    subscription = make_graph_api_call(
+        "PATCH", f"/subscriptions/{subscription_id}", data={"expirationDateTime": expiration_datetime}
+    )
+    logger.info(f"Renewed Graph subscription {subscription_id} until {expiration_datetime}.")
+    return subscription
+
+@profiled("graph.get_body")
+def get_email_body(message_id, mailbox=None):
+    """Fetches just the body content of a message (used to reload a released EmailRecord body)."""
+    mailbox = mailbox or SHARED_MAILBOX_ADDRESS
+    url_suffix = f"/users/{mailbox}/messages/{message_id}"
+    try:
+        response_data = make_graph_api_call("GET", url_suffix, params={"$select": "body,bodyPreview"}) or {}
+        return (response_data.get("body") or {}).get("content") or response_data.get("bodyPreview", "")
+    except Exception as e:
+        logger.error(f"Error fetching body for message ID {message_id}: {e}")
+        return ""
+
+EmailRecord.body_loader = get_email_body
+
+@profiled("graph.get_details")
+def get_email_details(message_id: str, mailbox: str | None = None) -> EmailRecord | None:
     """
     Fetches specific details for a single email message to provide context for drafting a reply.
-    Includes subject, body (consolidated), and sender information (reply_to_address).
+    Returns an EmailRecord: `body` is the consolidated body (falls back to the preview) and
+    `sender` is the address to reply to ('from', or 'sender' when 'from' is missing).
     """
-    print(f"Fetching full details for message ID {message_id} in mailbox {SHARED_MAILBOX_ADDRESS}...")
+    mailbox = mailbox or SHARED_MAILBOX_ADDRESS
+    logger.debug(f"Fetching full details for message ID {message_id} in mailbox {mailbox}...")
     
     # Define the fields you want to select.
     # 'from' gives the original sender. 'sender' is who sent it if on behalf of someone.
     # 'body' is preferred, 'bodyPreview' is a fallback.
-    select_fields = "id,subject,body,bodyPreview,from,sender,toRecipients,ccRecipients,conversationId"
-    url_suffix = f"/users/{SHARED_MAILBOX_ADDRESS}/messages/{message_id}"
+    select_fields = "id,internetMessageId,subject,body,bodyPreview,from,sender,conversationId,hasAttachments"
+    url_suffix = f"/users/{mailbox}/messages/{message_id}"
     params = {"$select": select_fields}
 
     try:
         response_data = make_graph_api_call("GET", url_suffix, params=params)
 
         if not response_data:
-            print(f"Could not fetch details for message ID {message_id}. Response was empty or API call failed.")
+            logger.warning(f"Could not fetch details for message ID {message_id}. Response was empty or API call failed.")
             return None
 
-        # Consolidate body content
-        body_content = ""
-        if response_data.get('body') and response_data['body'].get('content'):
-            body_content = response_data['body']['content']
-        elif response_data.get('bodyPreview'):
-            body_content = response_data['bodyPreview']
-        
-        # Determine the primary email address to reply to from the 'from' field.
-        original_sender_email = None
-        original_sender_name = "N/A"
-        if response_data.get('from') and response_data['from'].get('emailAddress'):
-            original_sender_email = response_data['from']['emailAddress'].get('address')
-            original_sender_name = response_data['from']['emailAddress'].get('name', 'N/A')
-        elif response_data.get('sender') and response_data['sender'].get('emailAddress'): # Fallback
-            original_sender_email = response_data['sender']['emailAddress'].get('address')
-            original_sender_name = response_data['sender']['emailAddress'].get('name', 'N/A')
-
-        extracted_details = {
-            "id": response_data.get("id"),
-            "subject": response_data.get("subject"),
-            "consolidated_body": body_content,
-            "reply_to_address": original_sender_email,
-            "from_name": original_sender_name,
-            "from_address": original_sender_email, # Redundant but can be useful for some schemas
-            "to_recipients": response_data.get("toRecipients"),
-            "cc_recipients": response_data.get("ccRecipients"),
-            "conversation_id": response_data.get("conversationId")
-        }
-        
-        print(f"Successfully fetched and processed details for message ID {message_id}. Reply-to address: {original_sender_email}")
-        return extracted_details
+        record = EmailRecord.from_graph(response_data, mailbox)
+        logger.debug(f"Successfully fetched and processed details for message ID {message_id}. Reply-to address: {record.sender}")
+        return record
 
     except Exception as e:
-        print(f"Error in get_email_details for message ID {message_id}: {e}")
+        logger.error(f"Error in get_email_details for message ID {message_id}: {e}")
         return None
 
 # --- Test functions ---
@@ -276,8 +558,8 @@ def _test_get_and_move_emails(target_folder_id_map):
     unread_emails = get_unread_emails(folder_id="inbox", top_n=1) 
     if unread_emails:
         email_to_move = unread_emails[0]
-        email_id = email_to_move['id']
-        print(f"Found email to test: Subject: '{email_to_move.get('subject', 'N/A')}', ID: {email_id}")
+        email_id = email_to_move.id
+        print(f"Found email to test: Subject: '{email_to_move.subject or 'N/A'}', ID: {email_id}")
 
         print(f"  Testing get_email_attachments for message ID: {email_id}")
         attachments = get_email_attachments(email_id)
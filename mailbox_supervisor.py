@@ -0,0 +1,189 @@
+import json
+import os
+import signal
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dotenv import load_dotenv
+
+from graph_helper import get_emails_by_ids, get_inbox_delta, get_unread_emails
+from email_sorter import get_target_folder_ids, process_emails
+from mutation_queue import get_mutation_executor
+from profiling import maybe_start_run
+from app_logging import get_logger, log_event
+
+load_dotenv()
+
+logger = get_logger("supervisor")
+
+# Sorts several mailboxes from one process. Each mailbox gets its own worker pool,
+# folder cache, delta cursor and throughput stats, so a busy mailbox can't starve the others.
+#   SORTER_MAILBOXES="sales@example.com=4,support@example.com=2,purchasing@example.com"
+SORTER_MAILBOXES = os.getenv("SORTER_MAILBOXES", "")
+SUPERVISOR_DEFAULT_WORKERS = int(os.getenv("SUPERVISOR_DEFAULT_WORKERS", "2"))
+SUPERVISOR_POLL_SECONDS = float(os.getenv("SUPERVISOR_POLL_SECONDS", "30"))
+SUPERVISOR_STATE_PATH = os.getenv("SUPERVISOR_STATE_PATH", "supervisor_state.json")
+SUPERVISOR_BATCH_SIZE = int(os.getenv("SUPERVISOR_BATCH_SIZE", "20"))
+FOLDER_CACHE_SECONDS = 60 * 60
+
+
+def parse_mailbox_config(config=SORTER_MAILBOXES):
+    """Parses 'mailbox[=workers],...' into a list of (mailbox, workers)."""
+    mailboxes = []
+    for entry in config.split(","):
+        entry = entry.strip()
+        if not entry:
+            continue
+        mailbox, _, workers = entry.partition("=")
+        mailboxes.append((mailbox.strip(), int(workers) if workers else SUPERVISOR_DEFAULT_WORKERS))
+    return mailboxes
+
+
+class CursorStore:
+    """Per-mailbox delta links persisted in one JSON file."""
+
+    def __init__(self, path=SUPERVISOR_STATE_PATH):
+        self.path = path
+        self.lock = threading.Lock()
+        self.cursors = {}
+        if os.path.exists(path):
+            with open(path, "r") as f:
+                self.cursors = json.load(f)
+
+    def get(self, mailbox):
+        with self.lock:
+            return self.cursors.get(mailbox)
+
+    def set(self, mailbox, delta_link):
+        with self.lock:
+            self.cursors[mailbox] = delta_link
+            with open(self.path, "w") as f:
+                json.dump(self.cursors, f, indent=2)
+
+
+class MailboxWorker:
+    """
+    Sorts one mailbox. Each cycle takes up to SUPERVISOR_BATCH_SIZE unread Inbox messages plus
+    new unread mail found with a delta query (the cursor), splits them by conversation into
+    `workers` shards, and sorts the shards in parallel. The unread poll works off the existing
+    backlog and retries mail the sorter held back, which the cursor has already moved past.
+    The first cycle without a cursor only seeds it (ids, no bodies).
+    """
+
+    def __init__(self, mailbox, workers, cursors):
+        self.mailbox = mailbox
+        self.workers = workers
+        self.cursors = cursors
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix=f"sort-{mailbox}")
+        self.folder_ids = None
+        self.folder_ids_fetched_at = 0.0
+        self.stats = {"cycles": 0, "processed": 0, "errors": 0, "busy_seconds": 0.0}
+
+    def _folder_ids(self):
+        if not self.folder_ids or time.monotonic() - self.folder_ids_fetched_at > FOLDER_CACHE_SECONDS:
+            folder_ids = get_target_folder_ids(mailbox=self.mailbox)
+            if all(folder_ids.values()):
+                self.folder_ids = folder_ids
+                self.folder_ids_fetched_at = time.monotonic()
+        return self.folder_ids
+
+    def _shards(self, emails):
+        # Whole conversations go to the same shard so each thread is still classified once.
+        shards = [[] for _ in range(self.workers)]
+        for email in emails:
+            key = email.conversation_id or email.id
+            shards[hash(key) % self.workers].append(email)
+        return [shard for shard in shards if shard]
+
+    def run_cycle(self):
+        started = time.monotonic()
+        processed = 0
+        try:
+            folder_ids = self._folder_ids()
+            if not folder_ids:
+                logger.warning(f"[{self.mailbox}] Missing target folder(s); skipping this cycle.")
+                return 0
+            unread = get_unread_emails(folder_id="inbox", top_n=SUPERVISOR_BATCH_SIZE,
+                                       expand_attachments=True, mailbox=self.mailbox)
+            cursor = self.cursors.get(self.mailbox)
+            messages, delta_link = get_inbox_delta(cursor, mailbox=self.mailbox)
+            if cursor:
+                polled_ids = {email.id for email in unread}
+                new_ids = [msg.id for msg in messages if not msg.is_read and msg.id not in polled_ids]
+                if new_ids:
+                    unread.extend(get_emails_by_ids(new_ids, mailbox=self.mailbox))
+            futures = [
+                self.pool.submit(process_emails, emails=shard, folder_ids=folder_ids, mailbox=self.mailbox)
+                for shard in self._shards(unread)
+            ]
+            for future in futures:
+                processed += len(future.result() or [])
+            if delta_link:
+                self.cursors.set(self.mailbox, delta_link)
+            return processed
+        except Exception as e:
+            self.stats["errors"] += 1
+            logger.error(f"[{self.mailbox}] ❌ Sorting cycle failed: {e}")
+            return processed
+        finally:
+            self.stats["cycles"] += 1
+            self.stats["processed"] += processed
+            self.stats["busy_seconds"] += time.monotonic() - started
+
+    def throughput(self):
+        busy = self.stats["busy_seconds"]
+        return self.stats["processed"] / busy if busy else 0.0
+
+    def shutdown(self):
+        self.pool.shutdown(wait=True)
+
+
+class MailboxSupervisor:
+    def __init__(self, mailbox_config, poll_seconds=SUPERVISOR_POLL_SECONDS):
+        cursors = CursorStore()
+        self.workers = [MailboxWorker(mailbox, workers, cursors) for mailbox, workers in mailbox_config]
+        self.poll_seconds = poll_seconds
+        self.stop_event = threading.Event()
+
+    def _run_mailbox(self, worker):
+        while not self.stop_event.is_set():
+            worker.run_cycle()
+            self.stop_event.wait(self.poll_seconds)
+
+    def run(self):
+        logger.info(f"🚀 Supervising {len(self.workers)} mailboxes: "
+                    + ", ".join(f"{w.mailbox} ({w.workers} workers)" for w in self.workers))
+        threads = [threading.Thread(target=self._run_mailbox, args=(worker,), name=worker.mailbox)
+                   for worker in self.workers]
+        for thread in threads:
+            thread.start()
+        while not self.stop_event.wait(self.poll_seconds * 10):
+            self.log_stats()
+        for thread in threads:
+            thread.join()
+        for worker in self.workers:
+            worker.shutdown()
+        get_mutation_executor().stop()
+        self.log_stats()
+
+    def request_stop(self, signum=None, frame=None):
+        logger.info(f"Received signal {signum}; finishing in-flight cycles before exit...")
+        self.stop_event.set()
+
+    def log_stats(self):
+        for worker in self.workers:
+            stats = worker.stats
+            log_event(logger, "mailbox_throughput", mailbox=worker.mailbox, processed=stats["processed"],
+                      cycles=stats["cycles"], emails_per_busy_second=round(worker.throughput(), 2), errors=stats["errors"])
+
+
+if __name__ == "__main__":
+    config = parse_mailbox_config()
+    if not config:
+        logger.critical('CRITICAL ERROR: SORTER_MAILBOXES is not set (e.g. SORTER_MAILBOXES="sales@example.com=4,support@example.com=2").')
+        exit()
+    maybe_start_run("supervisor")  # report is written when the supervisor exits
+    supervisor = MailboxSupervisor(config)
+    signal.signal(signal.SIGTERM, supervisor.request_stop)
+    signal.signal(signal.SIGINT, supervisor.request_stop)
+    supervisor.run()
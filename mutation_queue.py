@@ -0,0 +1,331 @@
+import argparse
+import os
+import sqlite3
+import threading
+import time
+from dotenv import load_dotenv
+
+from graph_helper import move_emails, update_emails
+from email_ledger import EmailLedger, STAGE_MOVED
+from profiling import profiled
+from app_logging import get_logger
+
+load_dotenv()
+
+logger = get_logger("mutations")
+
+# Write-behind queue for mailbox mutations. Classification only records what should
+# happen to a message; a background executor applies the actions in $batch requests,
+# retries failures with backoff, and keeps everything in SQLite so nothing is lost on a crash.
+MUTATION_QUEUE_PATH = os.getenv("MUTATION_QUEUE_PATH", "mutation_queue.db")
+MUTATION_MAX_ATTEMPTS = int(os.getenv("MUTATION_MAX_ATTEMPTS", "5"))
+MUTATION_RETRY_BASE_SECONDS = float(os.getenv("MUTATION_RETRY_BASE_SECONDS", "30"))
+MUTATION_FLUSH_SECONDS = float(os.getenv("MUTATION_FLUSH_SECONDS", "1.0"))
+MUTATION_COALESCE_SECONDS = 0.25  # after a wake-up, let the rest of a batch arrive before flushing
+
+ACTION_MOVE = "move"
+ACTION_MARK_READ = "mark_read"
+ACTION_FLAG = "flag"
+
+# Property changes run before moves: Graph gives a moved message a new id, so a PATCH
+# against the old id would fail once the move has been applied.
+ACTION_ORDER = (ACTION_MARK_READ, ACTION_FLAG, ACTION_MOVE)
+ACTION_CHANGES = {
+    ACTION_MARK_READ: {"isRead": True},
+    ACTION_FLAG: {"flag": {"flagStatus": "flagged"}},
+}
+
+STATUS_PENDING = "pending"
+STATUS_DONE = "done"
+STATUS_FAILED = "failed"
+
+
+class MutationQueue:
+    """
+    Durable queue of (mailbox, message_id, action) mutations. Enqueuing the same action for
+    the same message again replaces the pending entry, so repeated runs coalesce instead of
+    piling up duplicate moves. Safe to share between threads.
+    """
+
+    def __init__(self, path=MUTATION_QUEUE_PATH):
+        self.path = path
+        self.lock = threading.Lock()
+        self.wake = threading.Event()  # set on enqueue so the executor flushes promptly
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS mutations (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                mailbox TEXT NOT NULL,
+                message_id TEXT NOT NULL,
+                action TEXT NOT NULL,
+                argument TEXT,
+                internet_message_id TEXT,
+                status TEXT NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                next_attempt_at REAL NOT NULL,
+                last_error TEXT,
+                updated_at REAL NOT NULL,
+                UNIQUE (mailbox, message_id, action)
+            )
+            """
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS idx_mutations_due ON mutations (status, next_attempt_at)")
+        self.conn.commit()
+
+    def enqueue(self, action, message_id, argument=None, mailbox=None, internet_message_id=None):
+        """
+        Queues an action; `argument` is the destination folder ID for moves. A mutation that
+        already failed stays failed (only retry_failed() puts it back). Returns True when the
+        mutation is pending afterwards.
+        """
+        now = time.time()
+        with self.lock:
+            self.conn.execute(
+                """
+                INSERT INTO mutations (mailbox, message_id, action, argument, internet_message_id,
+                                       status, attempts, next_attempt_at, last_error, updated_at)
+                VALUES (?, ?, ?, ?, ?, ?, 0, ?, NULL, ?)
+                ON CONFLICT(mailbox, message_id, action) DO UPDATE SET
+                    argument = excluded.argument,
+                    internet_message_id = COALESCE(excluded.internet_message_id, mutations.internet_message_id),
+                    status = CASE WHEN mutations.status = 'done' AND mutations.argument IS NOT excluded.argument
+                                  THEN 'pending' ELSE mutations.status END,
+                    attempts = CASE WHEN mutations.status = 'done' THEN 0 ELSE mutations.attempts END,
+                    next_attempt_at = CASE WHEN mutations.status = 'done' THEN excluded.next_attempt_at
+                                           ELSE mutations.next_attempt_at END,
+                    updated_at = excluded.updated_at
+                """,
+                (mailbox or "", message_id, action, argument, internet_message_id, STATUS_PENDING, now, now)
+            )
+            status = self.conn.execute(
+                "SELECT status FROM mutations WHERE mailbox = ? AND message_id = ? AND action = ?",
+                (mailbox or "", message_id, action)
+            ).fetchone()[0]
+            self.conn.commit()
+        if status == STATUS_PENDING:
+            self.wake.set()
+        return status == STATUS_PENDING
+
+    def is_pending(self, message_id, action=ACTION_MOVE, mailbox=None):
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT 1 FROM mutations WHERE mailbox = ? AND message_id = ? AND action = ? AND status = ?",
+                (mailbox or "", message_id, action, STATUS_PENDING)
+            ).fetchone()
+        return row is not None
+
+    def due(self, now=None):
+        """Pending mutations whose next attempt is due, oldest first."""
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT * FROM mutations WHERE status = ? AND next_attempt_at <= ? ORDER BY id",
+                (STATUS_PENDING, now or time.time())
+            ).fetchall()
+        return [dict(row) for row in rows]
+
+    def pending_count(self):
+        with self.lock:
+            return self.conn.execute(
+                "SELECT COUNT(*) FROM mutations WHERE status = ?", (STATUS_PENDING,)
+            ).fetchone()[0]
+
+    def mark_done(self, mutation_ids):
+        with self.lock:
+            self.conn.executemany(
+                "UPDATE mutations SET status = ?, last_error = NULL, updated_at = ? WHERE id = ?",
+                [(STATUS_DONE, time.time(), mutation_id) for mutation_id in mutation_ids]
+            )
+            self.conn.commit()
+
+    def mark_retry(self, mutation_ids, error):
+        """
+        Schedules another attempt with exponential backoff. Returns the IDs that used up
+        MUTATION_MAX_ATTEMPTS and were marked failed instead.
+        """
+        failed = []
+        now = time.time()
+        with self.lock:
+            for mutation_id in mutation_ids:
+                attempts = self.conn.execute(
+                    "SELECT attempts FROM mutations WHERE id = ?", (mutation_id,)
+                ).fetchone()[0] + 1
+                if attempts >= MUTATION_MAX_ATTEMPTS:
+                    status, next_attempt_at = STATUS_FAILED, now
+                    failed.append(mutation_id)
+                else:
+                    status, next_attempt_at = STATUS_PENDING, now + MUTATION_RETRY_BASE_SECONDS * 2 ** (attempts - 1)
+                self.conn.execute(
+                    "UPDATE mutations SET status = ?, attempts = ?, next_attempt_at = ?, last_error = ?, updated_at = ? "
+                    "WHERE id = ?",
+                    (status, attempts, next_attempt_at, error, now, mutation_id)
+                )
+            self.conn.commit()
+        return failed
+
+    def failures(self):
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT * FROM mutations WHERE status = ? ORDER BY updated_at", (STATUS_FAILED,)
+            ).fetchall()
+        return [dict(row) for row in rows]
+
+    def retry_failed(self):
+        """Puts every failed mutation back in the queue with a fresh attempt budget."""
+        with self.lock:
+            count = self.conn.execute(
+                "UPDATE mutations SET status = ?, attempts = 0, next_attempt_at = ?, updated_at = ? WHERE status = ?",
+                (STATUS_PENDING, time.time(), time.time(), STATUS_FAILED)
+            ).rowcount
+            self.conn.commit()
+        self.wake.set()
+        return count
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+@profiled("mutations.apply")
+def apply_due_mutations(mutations, ledger):
+    """
+    Applies every due mutation, one $batch call per (action, mailbox, destination) group.
+    Successful moves are recorded as STAGE_MOVED in the ledger. Returns (applied, retried, failed).
+    """
+    groups = {}
+    for row in mutations.due():
+        groups.setdefault((row["action"], row["mailbox"], row["argument"]), []).append(row)
+
+    applied = retried = 0
+    failed = []
+    for key in sorted(groups, key=lambda key: ACTION_ORDER.index(key[0]) if key[0] in ACTION_ORDER else len(ACTION_ORDER)):
+        action, mailbox, argument = key
+        rows = groups[key]
+        message_ids = [row["message_id"] for row in rows]
+        try:
+            if action == ACTION_MOVE:
+                results = move_emails(message_ids, argument, mailbox=mailbox or None)
+            elif action in ACTION_CHANGES:
+                results = update_emails(message_ids, ACTION_CHANGES[action], mailbox=mailbox or None)
+            else:
+                failed += mutations.mark_retry([row["id"] for row in rows], f"Unknown action '{action}'")
+                continue
+        except Exception as e:
+            results = {}
+            logger.error(f"❌ Applying {len(rows)} '{action}' mutation(s) failed: {e}")
+
+        succeeded = [row for row in rows if results.get(row["message_id"]) is not None]
+        unsuccessful = [row["id"] for row in rows if results.get(row["message_id"]) is None]
+        mutations.mark_done([row["id"] for row in succeeded])
+        if action == ACTION_MOVE:
+            for row in succeeded:
+                ledger.record_stage(row["message_id"], STAGE_MOVED, internet_message_id=row["internet_message_id"],
+                                    mailbox=mailbox)
+        if unsuccessful:
+            now_failed = mutations.mark_retry(unsuccessful, f"Graph rejected '{action}' in mailbox {mailbox or 'default'}")
+            failed += now_failed
+            retried += len(unsuccessful) - len(now_failed)
+        applied += len(succeeded)
+
+    if failed:
+        logger.error(f"❌ {len(failed)} mailbox mutation(s) failed after {MUTATION_MAX_ATTEMPTS} attempts; "
+                     f"see `python mutation_queue.py report`.")
+    return applied, retried, failed
+
+
+class MutationExecutor(threading.Thread):
+    """Background thread that flushes the mutation queue shortly after anything is enqueued."""
+
+    def __init__(self, mutations, flush_seconds=MUTATION_FLUSH_SECONDS):
+        super().__init__(name="mutation-executor", daemon=True)
+        self.mutations = mutations
+        self.flush_seconds = flush_seconds
+        self.stop_event = threading.Event()
+        self.idle = threading.Event()
+        self.stats = {"applied": 0, "retried": 0, "failed": 0}
+
+    def run(self):
+        ledger = EmailLedger()  # SQLite connections stay on the thread that created them
+        try:
+            while not self.stop_event.is_set():
+                if self.mutations.wake.wait(self.flush_seconds):
+                    self.stop_event.wait(MUTATION_COALESCE_SECONDS)
+                self.mutations.wake.clear()
+                self.idle.clear()
+                try:
+                    applied, retried, failed = apply_due_mutations(self.mutations, ledger)
+                    self.stats["applied"] += applied
+                    self.stats["retried"] += retried
+                    self.stats["failed"] += len(failed)
+                except Exception as e:
+                    logger.error(f"❌ Mutation executor pass failed: {e}")
+                self.idle.set()
+        finally:
+            ledger.close()
+
+    def drain(self, timeout=60.0):
+        """
+        Waits until nothing is due (retries scheduled for later stay queued for the next run).
+        Returns True if the queue drained within `timeout`.
+        """
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            self.mutations.wake.set()
+            self.idle.clear()
+            if not self.idle.wait(max(0.0, deadline - time.monotonic())):
+                break
+            if not self.mutations.due():
+                return True
+        logger.warning(f"⚠️ {self.mutations.pending_count()} mailbox mutation(s) still queued; they will be retried on the next run.")
+        return False
+
+    def stop(self, timeout=60.0):
+        self.drain(timeout)
+        self.stop_event.set()
+        self.mutations.wake.set()
+        self.join(timeout)
+
+
+_queue = None
+_executor = None
+_singleton_lock = threading.Lock()
+
+
+def get_mutation_queue():
+    """Shared queue for the process; its executor thread is started on first use."""
+    global _queue, _executor
+    with _singleton_lock:
+        if _queue is None:
+            _queue = MutationQueue()
+            _executor = MutationExecutor(_queue)
+            _executor.start()
+    return _queue
+
+
+def get_mutation_executor():
+    get_mutation_queue()
+    return _executor
+
+
+def print_failure_report(mutations):
+    failures = mutations.failures()
+    logger.info(f"{len(failures)} failed mailbox mutation(s), {mutations.pending_count()} still pending.")
+    for row in failures:
+        logger.info(f"  [{row['mailbox'] or 'default'}] {row['action']} {row['message_id']} -> {row['argument']}: "
+                    f"{row['last_error']} ({row['attempts']} attempts)")
+    return failures
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Inspect or retry the mailbox mutation queue.")
+    parser.add_argument("command", choices=["report", "retry"], nargs="?", default="report")
+    args = parser.parse_args()
+
+    if args.command == "retry":
+        queue = get_mutation_queue()
+        logger.info(f"Re-queued {queue.retry_failed()} failed mutation(s).")
+        get_mutation_executor().stop()
+        print_failure_report(queue)
+    else:
+        print_failure_report(MutationQueue())
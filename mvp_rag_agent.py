@@ -1,12 +1,68 @@
 import json
+import os
+import re
+
+EMAIL_HISTORY_PATH = "email_history.json"  # past emails with their category and the reply that was sent
+RETRIEVAL_INDEX_PATH = "email_index"  # saved by `python retrieval_index.py --build email_history.json`
+RETRIEVAL_TOP_K = 5
+
+# A past reply is only a template: anything specific to that case is blanked out before reuse.
+PO_REFERENCE_PATTERN = re.compile(r"\b(p\.?o\.?|purchase order)(\s*(?:number|no\.?|#)?\s*:?\s*)([a-z0-9-]*\d[a-z0-9-]*)",
+                                  re.IGNORECASE)
+GREETING_PATTERN = re.compile(r"^(\s*(?:dear|hi|hello|hey)\s+)[^,\n]+", re.IGNORECASE | re.MULTILINE)
+REPLY_SPECIFIC_PATTERNS = [
+    (re.compile(r"[\w.+-]+@[\w-]+\.[\w.]+"), "[email]"),
+    (re.compile(r"[$€£]\s?\d[\d,]*(?:\.\d+)?|\b\d[\d,]*(?:\.\d+)?\s?(?:usd|eur|gbp)\b", re.IGNORECASE), "[price]"),
+    (re.compile(r"\b\d{4}-\d{2}-\d{2}\b|\b\d{1,2}/\d{1,2}/\d{2,4}\b|"
+                r"\b(?:jan|feb|mar|apr|may|jun|jul|aug|sep|oct|nov|dec)[a-z]*\.?\s+\d{1,2}(?:st|nd|rd|th)?(?:,?\s+\d{4})?\b",
+                re.IGNORECASE), "[date]"),
+    (re.compile(r"\b\d{4,}\b"), "[number]"),
+]
 
 # Load test emails from local .json file
 def load_test_emails(filepath="test_emails.json"):
     with open(filepath, "r") as f:
         return json.load(f)
 
-# Very basic RAG-like classification
-def classify_email(email_text):
+# Load the saved retrieval index over past emails; when history is newer, only the entries the
+# index hasn't seen yet are added (history is append-only) and the index is saved again
+def load_retrieval_index(filepath=EMAIL_HISTORY_PATH, index_path=RETRIEVAL_INDEX_PATH):
+    try:
+        from retrieval_index import RetrievalIndex  # optional: needs NumPy and SciPy
+    except ImportError:
+        print("NumPy/SciPy not installed; falling back to keyword rules and templates.")
+        return None
+
+    index_files = [f"{index_path}.npz", f"{index_path}.json"]
+    index = RetrievalIndex.load(index_path) if all(os.path.exists(path) for path in index_files) else None
+    if index is not None and (not os.path.exists(filepath)
+                              or min(os.path.getmtime(path) for path in index_files) >= os.path.getmtime(filepath)):
+        print(f"Loaded retrieval index of {len(index)} past emails from {index_path}.")
+        return index
+    if not os.path.exists(filepath):
+        print(f"No email history at {filepath}; falling back to keyword rules and templates.")
+        return None
+
+    with open(filepath, "r") as f:
+        history = json.load(f)
+    index = index or RetrievalIndex()
+    known_ids = {doc["id"] for doc in index.docs}
+    new_emails = [email for email in history if email["id"] not in known_ids]
+    index.add_many(new_emails)
+    index.save(index_path)
+    print(f"Added {len(new_emails)} past emails to the retrieval index ({len(index)} total) and saved it to {index_path}.")
+    return index
+
+# Classification from the most similar past emails, with keyword rules as a fallback
+def classify_email(email_text, index=None):
+    if index is not None:
+        votes = {}
+        for hit in index.query(email_text, k=RETRIEVAL_TOP_K):
+            if hit["category"]:
+                votes[hit["category"]] = votes.get(hit["category"], 0.0) + hit["score"]
+        if votes:
+            return max(votes, key=votes.get)
+
     text = email_text.lower()
     if "purchase order" in text or "po-" in text:
         return "Purchase Orders"
@@ -15,11 +71,29 @@ def classify_email(email_text):
     else:
         return "Needs Attention"
 
-# Draft reply based on classification
-def draft_reply(category, email_data):
+# Turn a past reply into a template: its greeting name, PO numbers, prices, dates and other specifics are removed
+def reply_template(reply):
+    template = GREETING_PATTERN.sub(lambda match: match.group(1) + "{name}", reply)
+    template = PO_REFERENCE_PATTERN.sub(lambda match: match.group(1) + match.group(2) + "{po_number}", template)
+    for pattern, placeholder in REPLY_SPECIFIC_PATTERNS:
+        template = pattern.sub(placeholder, template)
+    return template
+
+# Draft reply based on classification, using the approved reply to the most similar past case as a template
+def draft_reply(category, email_data, index=None):
     sender = email_data["from"]
     name = sender.split("@")[0].capitalize()
 
+    if index is not None:
+        query_text = f"{email_data.get('subject', '')} {email_data.get('body', '')}"
+        for hit in index.query(query_text, k=RETRIEVAL_TOP_K):
+            if hit["category"] == category and hit["reply"]:
+                # Only this email's own PO number is filled in; other placeholders stay visible for the reviewer.
+                po_numbers = {match.group(3) for match in PO_REFERENCE_PATTERN.finditer(query_text)}
+                po_number = po_numbers.pop() if len(po_numbers) == 1 else "[PO number]"
+                body = reply_template(hit["reply"]).replace("{name}", name).replace("{po_number}", po_number)
+                return f"Re: {email_data['subject']}", body
+
     if category == "Purchase Orders":
         subject = f"Re: {email_data['subject']}"
         body = f"""Dear {name},
@@ -58,9 +132,10 @@ def log_output(email_id, category, subject, body):
 # MVP runner
 def run_mvp():
     emails = load_test_emails()
+    index = load_retrieval_index()
     for email in emails:
-        category = classify_email(email["body"])
-        subject, body = draft_reply(category, email)
+        category = classify_email(email["body"], index)
+        subject, body = draft_reply(category, email, index)
         log_output(email["id"], category, subject, body)
 
 if __name__ == "__main__":
@@ -0,0 +1,288 @@
+import argparse
+import atexit
+import contextlib
+import cProfile
+import functools
+import io
+import json
+import os
+import pstats
+import re
+import runpy
+import sys
+import threading
+import time
+import tracemalloc
+from datetime import datetime
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Opt-in per-stage profiling for sorter and crew runs. Pipeline stages are wrapped in
+# span()/profiled(); while no run is active they cost one flag check. A finished run writes
+#   <name>-<timestamp>.folded  self time per stack in microseconds (flamegraph.pl / speedscope)
+#   <name>-<timestamp>.txt     per-stage summary table (+ cProfile / tracemalloc top lists)
+#   <name>-<timestamp>.json    per-stage numbers, for `python profiling.py diff OLD.json NEW.json`
+#   <name>-<timestamp>.prof    raw cProfile stats, when PROFILE_CPROFILE is on
+# Times are per thread. The "net blocks" / "net KiB" columns are process-wide deltas
+# (sys.getallocatedblocks / tracemalloc) between a span's start and end, so in a threaded
+# run they include what other threads allocated meanwhile; read them as hints, not totals.
+PROFILE_ENABLED = os.getenv("PROFILE_ENABLED", "false").lower() == "true"
+PROFILE_CPROFILE = os.getenv("PROFILE_CPROFILE", "false").lower() == "true"
+PROFILE_TRACEMALLOC = os.getenv("PROFILE_TRACEMALLOC", "false").lower() == "true"
+PROFILE_DIR = os.getenv("PROFILE_DIR", "profiles")
+PROFILE_TOP_N = 20
+
+_active = False
+_run = None
+_lock = threading.Lock()
+_local = threading.local()
+_stats = {}  # (thread, stage, ..., stage) -> [calls, total_s, self_s, net_blocks, net_traced_bytes]
+
+
+def _stack():
+    stack = getattr(_local, "stack", None)
+    if stack is None:
+        stack = _local.stack = []
+    return stack
+
+
+def _thread_root():
+    # Pool threads are numbered ("sort-x@y.com_3"); folding them keeps stacks comparable between runs.
+    return re.sub(r"_\d+$", "", threading.current_thread().name)
+
+
+def _add(key, elapsed, self_time, blocks=0, traced=0):
+    with _lock:
+        entry = _stats.setdefault(key, [0, 0.0, 0.0, 0, 0])
+        entry[0] += 1
+        entry[1] += elapsed
+        entry[2] += self_time
+        entry[3] += blocks
+        entry[4] += traced
+
+
+class _Span:
+    __slots__ = ("stage", "started", "child_time", "blocks", "traced")
+
+    def __init__(self, stage):
+        self.stage = stage
+
+    def __enter__(self):
+        _stack().append(self)
+        self.child_time = 0.0
+        self.blocks = sys.getallocatedblocks()
+        self.traced = tracemalloc.get_traced_memory()[0] if tracemalloc.is_tracing() else 0
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        elapsed = time.perf_counter() - self.started
+        stack = _stack()
+        key = (_thread_root(),) + tuple(span.stage for span in stack)
+        stack.pop()
+        if stack:
+            stack[-1].child_time += elapsed
+        traced = tracemalloc.get_traced_memory()[0] - self.traced if tracemalloc.is_tracing() else 0
+        _add(key, elapsed, elapsed - self.child_time, sys.getallocatedblocks() - self.blocks, traced)
+        return False
+
+
+_NO_SPAN = contextlib.nullcontext()
+
+
+def span(stage):
+    """Context manager timing one pipeline stage; a no-op unless a profiling run is active."""
+    return _Span(stage) if _active else _NO_SPAN
+
+
+def profiled(stage):
+    """Decorator form of span()."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _active:
+                return func(*args, **kwargs)
+            with _Span(stage):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def record(stage, seconds):
+    """Adds an interval timed elsewhere (e.g. by a framework callback) under the current stack."""
+    if _active:
+        stack = _stack()
+        key = (_thread_root(),) + tuple(span.stage for span in stack) + (stage,)
+        if stack:
+            stack[-1].child_time += seconds
+        _add(key, seconds, seconds)
+
+
+def _crew_step_mark():
+    # (time, child time of the enclosing span) at the last agent step
+    stack = _stack()
+    return time.perf_counter(), stack[-1].child_time if stack else 0.0
+
+
+def start_crew_steps():
+    """Call at crew kickoff, inside its span: the first agent turn is timed from here."""
+    if _active:
+        _local.last_step = _crew_step_mark()
+
+
+def crew_step_callback(step_output):
+    """
+    Crew step_callback: records the time since the previous agent step as one
+    "crew.agent_turn" (the LLM call), minus the time spent in nested spans such as
+    tools, which are recorded under their own stages.
+    """
+    if not _active:
+        return
+    now, child_time = _crew_step_mark()
+    last_step, last_child_time = getattr(_local, "last_step", None) or (_run["started"], 0.0)
+    record("crew.agent_turn", max(now - last_step - (child_time - last_child_time), 0.0))
+    _local.last_step = _crew_step_mark()
+
+
+def start_run(name, cprofile=PROFILE_CPROFILE, trace_memory=PROFILE_TRACEMALLOC):
+    """Starts collecting; finish_run() (registered at exit) writes the report."""
+    global _active, _run
+    with _lock:
+        _stats.clear()
+    profiler = None
+    if cprofile:
+        profiler = cProfile.Profile()  # only sees the thread that started the run
+        profiler.enable()
+    if trace_memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+    _run = {"name": name, "started": time.perf_counter(), "started_at": datetime.now(), "profiler": profiler}
+    _active = True
+    atexit.register(finish_run)
+    print(f"⏱️ Profiling run '{name}' (cProfile: {bool(cprofile)}, tracemalloc: {bool(trace_memory)})")
+
+
+def maybe_start_run(name):
+    """Entry points call this; it starts a run only when PROFILE_ENABLED is set and none is active."""
+    if PROFILE_ENABLED and not _active:
+        start_run(name)
+
+
+def _stage_summary(stats, wall_seconds):
+    stages = {}
+    for key, (calls, total, self_time, blocks, traced) in stats.items():
+        stage = stages.setdefault(key[-1], {"calls": 0, "total_ms": 0.0, "self_ms": 0.0,
+                                            "net_blocks": 0, "net_traced_kib": 0.0})
+        stage["calls"] += calls
+        if key[-1] not in key[1:-1]:  # recursive re-entries are already inside the outer total
+            stage["total_ms"] += total * 1000
+        stage["self_ms"] += self_time * 1000
+        stage["net_blocks"] += blocks
+        stage["net_traced_kib"] += traced / 1024
+    for stage in stages.values():
+        stage["mean_ms"] = stage["total_ms"] / stage["calls"]
+        stage["pct_of_run"] = 100.0 * stage["total_ms"] / 1000 / wall_seconds if wall_seconds else 0.0
+        for field in ("total_ms", "self_ms", "mean_ms", "pct_of_run", "net_traced_kib"):
+            stage[field] = round(stage[field], 3)
+    return dict(sorted(stages.items(), key=lambda item: -item[1]["self_ms"]))
+
+
+def format_summary_table(stages):
+    lines = [f"{'stage':<32} {'calls':>7} {'total ms':>11} {'mean ms':>9} {'self ms':>11} {'% run':>6} "
+             f"{'net blocks':>11} {'net KiB':>9}"]
+    for stage, s in stages.items():
+        lines.append(f"{stage:<32} {s['calls']:>7} {s['total_ms']:>11.1f} {s['mean_ms']:>9.2f} {s['self_ms']:>11.1f} "
+                     f"{s['pct_of_run']:>6.1f} {s['net_blocks']:>11} {s['net_traced_kib']:>9.1f}")
+    return "\n".join(lines)
+
+
+def finish_run():
+    """Stops collecting and writes the report files. Returns their common path prefix (or None)."""
+    global _active, _run
+    if not _active:
+        return None
+    _active = False
+    run, _run = _run, None
+    wall_seconds = time.perf_counter() - run["started"]
+    profiler = run["profiler"]
+    if profiler:
+        profiler.disable()
+
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    prefix = os.path.join(PROFILE_DIR, f"{run['name']}-{run['started_at']:%Y%m%d-%H%M%S}")
+    with _lock:
+        stats = dict(_stats)
+    stages = _stage_summary(stats, wall_seconds)
+
+    with open(f"{prefix}.folded", "w") as f:
+        for key, (_, _, self_time, _, _) in sorted(stats.items()):
+            f.write(f"{';'.join(key)} {max(int(self_time * 1_000_000), 0)}\n")
+
+    report = [f"Profile '{run['name']}' started {run['started_at']:%Y-%m-%d %H:%M:%S}, wall time {wall_seconds:.2f}s", "",
+              format_summary_table(stages), "",
+              "net blocks / net KiB: process-wide allocation deltas over each span, including other threads."]
+    if tracemalloc.is_tracing():
+        current, peak = tracemalloc.get_traced_memory()
+        report += ["", f"tracemalloc: current {current / 2**20:.1f} MiB, peak {peak / 2**20:.1f} MiB. Top allocation sites:"]
+        report += [f"  {stat}" for stat in tracemalloc.take_snapshot().statistics("lineno")[:PROFILE_TOP_N]]
+        tracemalloc.stop()
+    if profiler:
+        profiler.dump_stats(f"{prefix}.prof")
+        buffer = io.StringIO()
+        pstats.Stats(profiler, stream=buffer).sort_stats("cumulative").print_stats(PROFILE_TOP_N)
+        report += ["", "cProfile (main thread), top functions by cumulative time:", buffer.getvalue()]
+    with open(f"{prefix}.txt", "w") as f:
+        f.write("\n".join(report) + "\n")
+
+    with open(f"{prefix}.json", "w") as f:
+        json.dump({"name": run["name"], "started_at": run["started_at"].isoformat(),
+                   "wall_seconds": round(wall_seconds, 3), "stages": stages}, f, indent=2)
+
+    print(f"⏱️ Profile written to {prefix}.txt / .folded / .json" + (" / .prof" if profiler else ""))
+    return prefix
+
+
+def diff_reports(old_path, new_path):
+    """Prints per-stage total/mean time changes between two .json reports."""
+    with open(old_path, "r") as f:
+        old = json.load(f)
+    with open(new_path, "r") as f:
+        new = json.load(f)
+    print(f"wall time: {old['wall_seconds']:.2f}s -> {new['wall_seconds']:.2f}s")
+    print(f"{'stage':<32} {'old total ms':>13} {'new total ms':>13} {'change':>8} {'old mean':>9} {'new mean':>9}")
+    for stage in sorted(set(old["stages"]) | set(new["stages"])):
+        a = old["stages"].get(stage, {})
+        b = new["stages"].get(stage, {})
+        a_total, b_total = a.get("total_ms", 0.0), b.get("total_ms", 0.0)
+        change = f"{(b_total - a_total) / a_total * 100:+.0f}%" if a_total else "new"
+        print(f"{stage:<32} {a_total:>13.1f} {b_total:>13.1f} {change:>8} {a.get('mean_ms', 0.0):>9.2f} {b.get('mean_ms', 0.0):>9.2f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Profile a sorter pass or a crew run, or diff two reports.")
+    subcommands = parser.add_subparsers(dest="command", required=True)
+    for command, help_text in (("sort", "One process_emails() pass."), ("crew", "A full run_crew.py run.")):
+        run_parser = subcommands.add_parser(command, help=help_text)
+        run_parser.add_argument("--cprofile", action="store_true", default=PROFILE_CPROFILE)
+        run_parser.add_argument("--tracemalloc", action="store_true", default=PROFILE_TRACEMALLOC)
+    diff_parser = subcommands.add_parser("diff", help="Compare two .json reports.")
+    diff_parser.add_argument("old")
+    diff_parser.add_argument("new")
+    args = parser.parse_args()
+
+    # The pipeline modules import `profiling`, not this `__main__` copy, so the run has to be
+    # started on the imported module for their spans to be recorded.
+    import profiling
+
+    if args.command == "diff":
+        diff_reports(args.old, args.new)
+    elif args.command == "sort":
+        profiling.start_run("sort", cprofile=args.cprofile, trace_memory=args.tracemalloc)
+        from email_sorter import process_emails
+        from mutation_queue import get_mutation_executor
+        process_emails()
+        with profiling.span("mutations.drain"):
+            get_mutation_executor().drain()
+    else:
+        profiling.start_run("crew", cprofile=args.cprofile, trace_memory=args.tracemalloc)
+        runpy.run_module("run_crew", run_name="__main__")
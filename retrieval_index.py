@@ -0,0 +1,176 @@
+import argparse
+import json
+import random
+import re
+import time
+
+import numpy as np
+from scipy import sparse
+
+# BM25 retrieval over past emails (and the replies that were sent), used by
+# mvp_rag_agent to classify and draft from the most similar past cases.
+BM25_K1 = 1.5
+BM25_B = 0.75
+TOKEN_PATTERN = re.compile(r"[a-z0-9]{2,}")
+
+
+def tokenize(text):
+    return TOKEN_PATTERN.findall((text or "").lower())
+
+
+class RetrievalIndex:
+    """
+    Sparse BM25 index. Documents are appended incrementally; raw term counts live in a
+    CSR matrix and the BM25 weights (stored column-major) are recomputed lazily, in one
+    O(nnz) pass, on the first query after new documents arrive.
+    """
+
+    def __init__(self):
+        self.vocabulary = {}   # token -> column
+        self.docs = []         # per-row metadata: id, category, subject, reply
+        self.counts = sparse.csr_matrix((0, 0), dtype=np.float32)
+        self._pending_rows = []  # (columns, counts) for documents not yet stacked into `counts`
+        self._weights = None     # BM25-weighted matrix, None when stale
+
+    def __len__(self):
+        return len(self.docs)
+
+    def add(self, doc_id, text, category=None, subject=None, reply=None):
+        """Adds one past email. `reply` is the approved reply that was sent for it, if any."""
+        row = {}
+        for token in tokenize(text):
+            column = self.vocabulary.setdefault(token, len(self.vocabulary))
+            row[column] = row.get(column, 0) + 1
+        self._pending_rows.append((np.fromiter(row.keys(), dtype=np.int32, count=len(row)),
+                                   np.fromiter(row.values(), dtype=np.float32, count=len(row))))
+        self.docs.append({"id": doc_id, "category": category, "subject": subject, "reply": reply})
+        self._weights = None
+
+    def add_many(self, emails):
+        """Adds dicts with 'id', 'body' and optionally 'subject', 'category', 'reply'."""
+        for email in emails:
+            self.add(email["id"], f"{email.get('subject', '')} {email.get('body', '')}",
+                     category=email.get("category"), subject=email.get("subject"), reply=email.get("reply"))
+
+    def _flush_pending(self):
+        if not self._pending_rows:
+            return
+        indptr = np.zeros(len(self._pending_rows) + 1, dtype=np.int64)
+        np.cumsum([len(columns) for columns, _ in self._pending_rows], out=indptr[1:])
+        indices = np.concatenate([columns for columns, _ in self._pending_rows])
+        data = np.concatenate([counts for _, counts in self._pending_rows])
+        n_terms = len(self.vocabulary)
+        new_rows = sparse.csr_matrix((data, indices, indptr), shape=(len(self._pending_rows), n_terms))
+        old = self.counts
+        old.resize((old.shape[0], n_terms))  # the vocabulary may have grown
+        self.counts = sparse.vstack([old, new_rows], format="csr")
+        self._pending_rows = []
+
+    def _bm25_weights(self):
+        if self._weights is not None:
+            return self._weights
+        self._flush_pending()
+        counts = self.counts
+        n_docs = counts.shape[0]
+        doc_lengths = np.asarray(counts.sum(axis=1)).ravel()
+        avg_length = doc_lengths.mean() if n_docs else 0.0
+        doc_freq = np.bincount(counts.indices, minlength=counts.shape[1])
+        self.idf = np.log(1.0 + (n_docs - doc_freq + 0.5) / (doc_freq + 0.5)).astype(np.float32)
+
+        weights = counts.copy()
+        row_lengths = np.repeat(doc_lengths, np.diff(counts.indptr))
+        tf = weights.data
+        norm = BM25_K1 * (1.0 - BM25_B + BM25_B * row_lengths / (avg_length or 1.0))
+        weights.data = (tf * (BM25_K1 + 1.0) / (tf + norm) * self.idf[weights.indices]).astype(np.float32)
+        # Column-major, so a query only touches the postings of its own terms.
+        self._weights = weights.tocsc()
+        return self._weights
+
+    def query(self, text, k=5):
+        """Returns up to k {"score", "id", "category", "subject", "reply"} dicts, best match first."""
+        if not self.docs:
+            return []
+        weights = self._bm25_weights()
+        columns = [self.vocabulary[token] for token in set(tokenize(text)) if token in self.vocabulary]
+        if not columns:
+            return []
+        scores = np.asarray(weights[:, columns].sum(axis=1)).ravel()
+        k = min(k, len(scores))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [dict(self.docs[i], score=float(scores[i])) for i in top if scores[i] > 0]
+
+    def save(self, path):
+        """Writes the index to `path`.npz plus `path`.json."""
+        self._flush_pending()
+        sparse.save_npz(f"{path}.npz", self.counts)
+        with open(f"{path}.json", "w") as f:
+            json.dump({"vocabulary": self.vocabulary, "docs": self.docs}, f)
+
+    @classmethod
+    def load(cls, path):
+        index = cls()
+        index.counts = sparse.load_npz(f"{path}.npz").tocsr()
+        with open(f"{path}.json", "r") as f:
+            meta = json.load(f)
+        index.vocabulary = meta["vocabulary"]
+        index.docs = meta["docs"]
+        return index
+
+
+def build_index_from_history(filepath="email_history.json"):
+    """
+    Builds an index from a JSON list of past emails with 'id', 'subject', 'body',
+    'category' and (when a reply was approved and sent) 'reply'.
+    """
+    with open(filepath, "r") as f:
+        history = json.load(f)
+    index = RetrievalIndex()
+    index.add_many(history)
+    return index
+
+
+def benchmark(n_docs=100_000, n_queries=200, vocabulary_size=20_000, doc_length=120):
+    """Times index build and query latency on synthetic documents."""
+    rng = random.Random(42)
+    words = [f"w{i}" for i in range(vocabulary_size)]
+    # Zipf-like term distribution, closer to real mail than uniform sampling
+    weights = [1.0 / (rank + 1) for rank in range(vocabulary_size)]
+    categories = ["Purchase Orders", "Quote Requests", "Needs Attention"]
+
+    docs = [" ".join(rng.choices(words, weights=weights, k=doc_length)) for _ in range(n_docs)]
+    queries = [" ".join(rng.choices(words, weights=weights, k=20)) for _ in range(n_queries)]
+
+    index = RetrievalIndex()
+    started = time.perf_counter()
+    for i, text in enumerate(docs):
+        index.add(str(i), text, category=categories[i % 3])
+    index._bm25_weights()
+    build_seconds = time.perf_counter() - started
+
+    latencies = []
+    for text in queries:
+        started = time.perf_counter()
+        index.query(text, k=5)
+        latencies.append((time.perf_counter() - started) * 1000)
+    latencies.sort()
+    print(f"Indexed {n_docs} docs ({len(index.vocabulary)} terms, {index.counts.nnz} nonzeros) in {build_seconds:.2f}s")
+    print(f"Query latency over {n_queries} queries: p50 {latencies[len(latencies) // 2]:.2f} ms, "
+          f"p95 {latencies[int(len(latencies) * 0.95)]:.2f} ms")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build or benchmark the email retrieval index.")
+    parser.add_argument("--benchmark", type=int, metavar="N_DOCS", help="Benchmark with N synthetic documents.")
+    parser.add_argument("--build", metavar="HISTORY_JSON", help="Build an index from a history file.")
+    parser.add_argument("--out", default="email_index", help="Output path prefix for --build.")
+    args = parser.parse_args()
+
+    if args.benchmark:
+        benchmark(n_docs=args.benchmark)
+    elif args.build:
+        built = build_index_from_history(args.build)
+        built.save(args.out)
+        print(f"Saved index of {len(built)} emails to {args.out}.npz/.json")
+    else:
+        parser.print_help()
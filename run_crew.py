@@ -1,13 +1,23 @@
 from dotenv import load_dotenv
 import os
-from graph_helper import get_unread_emails, get_email_attachments
-from email_sorter import categorize_email # categorize_email is used by find_po_email_id
+from graph_helper import iter_unread_emails
+from email_sorter import categorize_email, email_attachments # used by find_po_email_id
+from duplicate_detector import email_fingerprint, get_duplicate_index
+from profiling import crew_step_callback, maybe_start_run, profiled, span, start_crew_steps
+from app_logging import get_logger
 from crewai import Crew, Task, Process
 from agents.basic_agents import emailer_agent, email_drafting_agent
 
 # Load environment variables
 load_dotenv()
 
+logger = get_logger("crew")
+
+# PROFILE_ENABLED=true: time each stage of this run (see profiling.py). Only when run as a
+# script, so importing this module never starts a profile.
+if __name__ == "__main__":
+    maybe_start_run("crew")
+
 print("🔧 Loaded environment configuration:")
 print("SHARED_MAILBOX_ADDRESS:", os.getenv("SHARED_MAILBOX_ADDRESS"))
 # print("AIRTABLE_PERSONAL_TOKEN:", os.getenv("AIRTABLE_PERSONAL_TOKEN")) # Potentially sensitive
@@ -17,37 +27,47 @@ print(f"TEST_MODE is: {os.getenv('TEST_MODE', 'false')}")
 
 
 # 🔍 STEP 1: Find a real Purchase Order email (or any email if needed)
+@profiled("crew.find_po_email")
 def find_po_email_id():
     """
     Scans unread emails for one categorized as "Purchase Orders".
     Returns the email ID if found, otherwise None.
     """
-    print("📥 Scanning inbox for a Purchase Order email...")
+    logger.info("📥 Scanning inbox for a Purchase Order email...")
     # Ensure SHARED_MAILBOX_ADDRESS is loaded for graph_helper functions
     if not os.getenv("SHARED_MAILBOX_ADDRESS"):
-        print("CRITICAL: SHARED_MAILBOX_ADDRESS is not set. Cannot scan for emails.")
-        return None
-        
-    emails = get_unread_emails(folder_id="inbox", top_n=20) # Check default inbox
-    if not emails:
-        print("No unread emails found in the inbox.")
+        logger.critical("CRITICAL: SHARED_MAILBOX_ADDRESS is not set. Cannot scan for emails.")
         return None
         
-    print(f"Found {len(emails)} unread emails to scan.")
-    for email in emails:
-        email_id_for_attachments = email.get('id')
-        attachments = []
-        if email_id_for_attachments and email.get('hasAttachments'):
-            attachments = get_email_attachments(email_id_for_attachments)
+    # Streamed: scanning starts with the first parsed message and stops at the first PO
+    scanned = 0
+    try:
+        for email in iter_unread_emails(folder_id="inbox", top_n=20, expand_attachments=True): # Check default inbox
+            scanned += 1
+            # Attachment metadata comes inline with the list page ($expand), no extra call per email
+            attachments = email_attachments(email)
+
+            # A near-duplicate of a PO we've already seen must not get a second drafted reply.
+            # Read-only: indexing (with the category) is the sorter's job.
+            original = get_duplicate_index().lookup(email.id, email_fingerprint(email, attachments))
+            if original:
+                logger.info(f"⏭️ Skipping near-duplicate of email {original['message_id']}: {email.subject or 'No Subject'}")
+                continue
         
-        # Use the same categorize_email function from email_sorter
-        category = categorize_email(email, attachments) 
+            # Use the same categorize_email function from email_sorter
+            category = categorize_email(email, attachments) 
         
-        if category == "Purchase Orders": # Make sure "Purchase Orders" matches the constant in email_sorter
-            print(f"✅ Found PO email: {email.get('subject', 'No Subject')} (ID: {email.get('id')})")
-            return email.get('id')
-            
-    print("⚠️ No Purchase Order email found among unread emails.")
+            if category == "Purchase Orders": # Make sure "Purchase Orders" matches the constant in email_sorter
+                logger.info(f"✅ Found PO email: {email.subject or 'No Subject'} (ID: {email.id})")
+                return email.id
+    except Exception as e:
+        logger.error(f"Error scanning unread emails: {e}")
+        return None
+
+    if not scanned:
+        logger.info("No unread emails found in the inbox.")
+        return None
+    logger.warning(f"⚠️ No Purchase Order email found among {scanned} unread emails.")
     return None
 
 # 🧠 TASK 1: Email Sorting
@@ -108,13 +128,16 @@ crew = Crew(
     agents=[emailer_agent, email_drafting_agent],
     tasks=tasks_to_run,
     verbose=True, # Set to 2 or True for detailed crew output
-    process=Process.sequential
+    process=Process.sequential,
+    step_callback=crew_step_callback # per-turn timing when profiling is on
 )
 
 if __name__ == "__main__":
     print("🚀 Running Crew...")
     # Kickoff the crew's work
-    result = crew.kickoff()
+    with span("crew.kickoff"):
+        start_crew_steps()
+        result = crew.kickoff()
     
     print("\n✅ Crew run complete.")
     print("📋 Final Result from Crew Kickoff:")
@@ -123,7 +146,9 @@ if __name__ == "__main__":
 
 if __name__ == "__main__":
     print("🚀 Running live crew agent...")
-    result = crew.kickoff()
+    with span("crew.kickoff"):
+        start_crew_steps()
+        result = crew.kickoff()
     print("\n✅ Crew run complete.")
     print(result)
 
@@ -0,0 +1,140 @@
+import argparse
+import hashlib
+import os
+import sqlite3
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Per-sender category counts learned from past classifications. When a sender address's
+# history is large and one-sided enough, the sorter uses it instead of running the full
+# keyword/regex cascade in categorize_email. Priors are per address only: one domain often
+# sends both quotes and POs from different people. `python sender_index.py rebuild` recounts
+# everything from the full classifications recorded in the email ledger.
+SENDER_INDEX_PATH = os.getenv("SENDER_INDEX_PATH", "sender_index.db")
+SENDER_PRIOR_MIN_SAMPLES = int(os.getenv("SENDER_PRIOR_MIN_SAMPLES", "25"))
+SENDER_PRIOR_MIN_SHARE = float(os.getenv("SENDER_PRIOR_MIN_SHARE", "0.95"))
+# Share of prior-decided mail that is classified in full anyway, so the counts keep
+# tracking senders whose mail changes over time.
+SENDER_PRIOR_AUDIT_RATE = float(os.getenv("SENDER_PRIOR_AUDIT_RATE", "0.1"))
+
+# decided_by values of a full classification; only these are counted.
+FULL_CLASSIFICATION_SOURCES = ("classifier", "attachment_scan")
+
+
+def _sender_key(from_email):
+    address = (from_email or "").strip().lower()
+    if "@" not in address:
+        return None
+    return f"addr:{address}"
+
+
+class SenderPriorIndex:
+    """
+    Counts of categories per sender address.
+    Counts are persisted in SQLite and mirrored in a dict so lookups are O(1).
+    """
+
+    def __init__(self, path=SENDER_INDEX_PATH):
+        self.conn = sqlite3.connect(path)
+        self.conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS sender_counts (
+                sender_key TEXT NOT NULL,
+                category TEXT NOT NULL,
+                count INTEGER NOT NULL,
+                PRIMARY KEY (sender_key, category)
+            )
+            """
+        )
+        self.conn.commit()
+        self.counts = {}
+        for sender_key, category, count in self.conn.execute("SELECT sender_key, category, count FROM sender_counts"):
+            self.counts.setdefault(sender_key, {})[category] = count
+
+    def _increment(self, sender_key, category, amount):
+        per_category = self.counts.setdefault(sender_key, {})
+        per_category[category] = per_category.get(category, 0) + amount
+        self.conn.execute(
+            """
+            INSERT INTO sender_counts (sender_key, category, count) VALUES (?, ?, ?)
+            ON CONFLICT(sender_key, category) DO UPDATE SET count = count + excluded.count
+            """,
+            (sender_key, category, amount)
+        )
+
+    def record(self, from_email, category, amount=1, commit=True):
+        """Adds one full classification result for a sender to the index."""
+        sender_key = _sender_key(from_email)
+        if not sender_key or not category:
+            return
+        self._increment(sender_key, category, amount)
+        if commit:
+            self.conn.commit()
+
+    def _confident_category(self, sender_key):
+        per_category = self.counts.get(sender_key)
+        if not per_category:
+            return None
+        total = sum(per_category.values())
+        category, count = max(per_category.items(), key=lambda item: item[1])
+        if total >= SENDER_PRIOR_MIN_SAMPLES and count / total >= SENDER_PRIOR_MIN_SHARE:
+            return category
+        return None
+
+    def lookup(self, from_email):
+        """
+        Returns the category this sender's mail almost always lands in, or None when
+        the history is too short or too mixed.
+        """
+        sender_key = _sender_key(from_email)
+        return self._confident_category(sender_key) if sender_key else None
+
+    @staticmethod
+    def should_audit(message_id, rate=SENDER_PRIOR_AUDIT_RATE):
+        """
+        True for the sample of messages that get a full classification despite a prior.
+        Chosen by message id, so a re-run audits the same messages.
+        """
+        bucket = int.from_bytes(hashlib.blake2b((message_id or "").encode("utf-8"), digest_size=4).digest(), "big")
+        return bucket < rate * 2**32
+
+    def rebuild_from_ledger(self, ledger):
+        """
+        Rebuilds all counts from the messages an EmailLedger recorded as fully classified;
+        mail routed by a prior, a thread or a duplicate is left out so priors never count themselves.
+        """
+        self._reset()
+        placeholders = ", ".join("?" for _ in FULL_CLASSIFICATION_SOURCES)
+        rows = ledger.conn.execute(
+            "SELECT from_email, category FROM messages WHERE category IS NOT NULL AND from_email IS NOT NULL "
+            f"AND decided_by IN ({placeholders})", FULL_CLASSIFICATION_SOURCES
+        )
+        for from_email, category in rows:
+            self.record(from_email, category, commit=False)
+        self.conn.commit()
+
+    def _reset(self):
+        self.counts = {}
+        self.conn.execute("DELETE FROM sender_counts")
+
+    def close(self):
+        self.conn.close()
+
+
+if __name__ == "__main__":
+    # The Airtable mirror is not a source: its rows don't say how a category was decided,
+    # so prior-decided mail would be counted again.
+    parser = argparse.ArgumentParser(description="Rebuild the sender prior index from the email ledger.")
+    parser.add_argument("command", choices=["rebuild"])
+    args = parser.parse_args()
+
+    from email_ledger import EmailLedger
+
+    ledger = EmailLedger()
+    index = SenderPriorIndex()
+    index.rebuild_from_ledger(ledger)
+    confident = sum(1 for sender_key in index.counts if index._confident_category(sender_key))
+    print(f"Rebuilt sender priors for {len(index.counts)} senders from {ledger.path}; {confident} have a confident prior.")
+    index.close()
+    ledger.close()
@@ -0,0 +1,164 @@
+import json
+import os
+import signal
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from dotenv import load_dotenv
+
+from graph_helper import get_unread_emails
+from email_sorter import get_target_folder_ids, process_emails
+from mutation_queue import get_mutation_executor
+from profiling import maybe_start_run
+from app_logging import get_logger
+
+load_dotenv()
+
+logger = get_logger("daemon")
+
+# Long-running alternative to calling process_emails on a schedule: the token cache,
+# folder IDs and Airtable client stay warm between cycles, and the poll interval adapts
+# to how busy the Inbox is.
+DAEMON_MIN_POLL_SECONDS = float(os.getenv("DAEMON_MIN_POLL_SECONDS", "5"))
+DAEMON_MAX_POLL_SECONDS = float(os.getenv("DAEMON_MAX_POLL_SECONDS", "300"))
+DAEMON_BATCH_SIZE = int(os.getenv("DAEMON_BATCH_SIZE", "20"))
+DAEMON_HEALTH_HOST = os.getenv("DAEMON_HEALTH_HOST", "127.0.0.1")
+DAEMON_HEALTH_PORT = int(os.getenv("DAEMON_HEALTH_PORT", "8766"))
+FOLDER_CACHE_SECONDS = 60 * 60
+
+
+class SorterDaemon:
+    def __init__(self, min_interval=DAEMON_MIN_POLL_SECONDS, max_interval=DAEMON_MAX_POLL_SECONDS):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.interval = min_interval
+        self.stop_event = threading.Event()
+        self.folder_ids = None
+        self.folder_ids_fetched_at = 0.0
+        self.lock = threading.Lock()
+        self.metrics = {
+            "started_at": time.time(),
+            "cycles": 0,
+            "queue_depth": 0,
+            "last_cycle_at": None,
+            "last_cycle_latency_seconds": None,
+            "last_cycle_processed": 0,
+            "total_processed": 0,
+            "failed_cycles": 0,
+            "poll_interval_seconds": self.interval,
+        }
+
+    def _folder_ids(self):
+        if not self.folder_ids or time.monotonic() - self.folder_ids_fetched_at > FOLDER_CACHE_SECONDS:
+            folder_ids = get_target_folder_ids()
+            if all(folder_ids.values()):
+                self.folder_ids = folder_ids
+                self.folder_ids_fetched_at = time.monotonic()
+        return self.folder_ids
+
+    def run_cycle(self):
+        """Fetches one page of unread mail and sorts it. Returns the number of emails processed."""
+        folder_ids = self._folder_ids()
+        if not folder_ids:
+            logger.warning("Missing target folder(s); skipping this cycle.")
+            return 0
+        emails = get_unread_emails(folder_id="inbox", top_n=DAEMON_BATCH_SIZE, expand_attachments=True)
+        with self.lock:
+            self.metrics["queue_depth"] = len(emails)
+        if not emails:
+            return 0
+        try:
+            return len(process_emails(emails=emails, folder_ids=folder_ids))
+        finally:
+            with self.lock:
+                self.metrics["queue_depth"] = 0
+
+    def _next_interval(self, processed):
+        # Mail is arriving: poll again quickly. Idle: back off exponentially up to the max.
+        if processed:
+            return self.min_interval
+        return min(self.interval * 2, self.max_interval)
+
+    def run(self):
+        logger.info(f"🚀 Sorter daemon started (poll {self.min_interval:.0f}-{self.max_interval:.0f}s).")
+        while not self.stop_event.is_set():
+            started = time.monotonic()
+            processed = 0
+            try:
+                processed = self.run_cycle()
+            except Exception as e:
+                logger.error(f"❌ Sorting cycle failed: {e}")
+                with self.lock:
+                    self.metrics["failed_cycles"] += 1
+
+            self.interval = self._next_interval(processed)
+            with self.lock:
+                self.metrics["cycles"] += 1
+                self.metrics["last_cycle_at"] = time.time()
+                self.metrics["last_cycle_latency_seconds"] = round(time.monotonic() - started, 3)
+                self.metrics["last_cycle_processed"] = processed
+                self.metrics["total_processed"] += processed
+                self.metrics["poll_interval_seconds"] = self.interval
+
+            # Waiting on the event lets SIGTERM end the sleep immediately; a cycle in progress
+            # always runs to completion before the loop exits.
+            self.stop_event.wait(self.interval)
+        get_mutation_executor().stop()
+        logger.info("Sorter daemon stopped; in-flight work drained.")
+
+    def request_stop(self, signum=None, frame=None):
+        logger.info(f"Received signal {signum}; finishing the current cycle before exit...")
+        self.stop_event.set()
+
+    def snapshot(self):
+        with self.lock:
+            metrics = dict(self.metrics)
+        metrics["uptime_seconds"] = round(time.time() - metrics["started_at"], 1)
+        metrics["stopping"] = self.stop_event.is_set()
+        executor = get_mutation_executor()
+        metrics["mutations_pending"] = executor.mutations.pending_count()
+        metrics["mutations_applied"] = executor.stats["applied"]
+        metrics["mutations_failed"] = executor.stats["failed"]
+        return metrics
+
+
+def start_health_server(daemon, host=DAEMON_HEALTH_HOST, port=DAEMON_HEALTH_PORT):
+    """Serves GET /health and GET /metrics (JSON) on a background thread."""
+
+    class HealthHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path not in ("/health", "/metrics"):
+                self.send_error(404)
+                return
+            metrics = daemon.snapshot()
+            if self.path == "/health":
+                body = {"status": "stopping" if metrics["stopping"] else "ok",
+                        "last_cycle_at": metrics["last_cycle_at"]}
+            else:
+                body = metrics
+            encoded = json.dumps(body).encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(encoded)))
+            self.end_headers()
+            self.wfile.write(encoded)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), HealthHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    logger.info(f"🩺 Health/metrics endpoint on http://{host}:{port}/health and /metrics")
+    return server
+
+
+if __name__ == "__main__":
+    maybe_start_run("daemon")  # report is written when the daemon exits
+    sorter_daemon = SorterDaemon()
+    signal.signal(signal.SIGTERM, sorter_daemon.request_stop)
+    signal.signal(signal.SIGINT, sorter_daemon.request_stop)
+    health_server = start_health_server(sorter_daemon)
+    try:
+        sorter_daemon.run()
+    finally:
+        health_server.shutdown()
@@ -0,0 +1,149 @@
+import os
+import tempfile
+import unittest
+
+from duplicate_detector import (
+    DuplicateIndex,
+    Fingerprint,
+    attachment_key,
+    email_features,
+    hamming_distance,
+    message_text,
+    po_key,
+    simhash,
+)
+
+PO_BODY = (
+    "<p>Hello team,</p><p>Please find attached our purchase order PO 4500123 for 200 steel brackets, "
+    "delivery to the Dayton warehouse by the end of the month. Invoice to accounts payable as usual.</p>"
+)
+PO_ATTACHMENTS = [{"name": "PO4500123.pdf", "size": 48213}]
+
+
+class SimHashTests(unittest.TestCase):
+    def test_empty_features_have_no_fingerprint(self):
+        self.assertIsNone(simhash({}))
+        self.assertIsNone(simhash(email_features("", "", [])))
+
+    def test_fingerprint_is_deterministic_and_64_bit(self):
+        features = email_features("PO 4500123", PO_BODY, PO_ATTACHMENTS)
+        self.assertEqual(simhash(features), simhash(dict(features)))
+        self.assertLess(simhash(features), 1 << 64)
+
+    def test_hamming_distance(self):
+        self.assertEqual(hamming_distance(0, 0), 0)
+        self.assertEqual(hamming_distance(0b1011, 0b0001), 2)
+        self.assertEqual(hamming_distance(0, (1 << 64) - 1), 64)
+
+    def test_forwarded_copy_hashes_the_same(self):
+        original = simhash(email_features("PO 4500123", PO_BODY, PO_ATTACHMENTS))
+        plain_body = PO_BODY.replace("<p>", "").replace("</p>", "\n") + "\nKind regards,\nJane Doe\nPurchasing"
+        forwarded = simhash(email_features("FW: PO 4500123", plain_body, PO_ATTACHMENTS))
+        self.assertEqual(hamming_distance(original, forwarded), 0)
+
+    def test_small_edit_stays_close(self):
+        original = simhash(email_features("PO 4500123", PO_BODY, PO_ATTACHMENTS))
+        edited = simhash(email_features("PO 4500123", PO_BODY.replace("as usual", "as always"), PO_ATTACHMENTS))
+        self.assertLessEqual(hamming_distance(original, edited), 3)
+
+    def test_unrelated_email_is_far(self):
+        original = simhash(email_features("PO 4500123", PO_BODY, PO_ATTACHMENTS))
+        other = simhash(email_features("Quote request", "Could you send pricing and lead time for 50 valves?", []))
+        self.assertGreater(hamming_distance(original, other), 3)
+
+    def test_subject_prefixes_are_ignored(self):
+        self.assertEqual(email_features("RE: FW: Order", "", []), email_features("Order", "", []))
+
+
+class MessageTextTests(unittest.TestCase):
+    def test_quoted_history_is_removed(self):
+        body = "Confirmed, thanks.\n\n-----Original Message-----\nFrom: buyer@example.com\nPO 4500123 attached"
+        self.assertEqual(message_text(body).strip(), "Confirmed, thanks.")
+
+    def test_reply_header_and_quote_markers_are_removed(self):
+        body = "See below.\n> earlier text\nOn Mon, Mar 4, 2024 at 9:00 AM Buyer <b@example.com> wrote:\n> more"
+        self.assertEqual(message_text(body).strip(), "See below.")
+
+    def test_html_blockquote_is_removed(self):
+        body = "<div>New text</div><blockquote>Old text</blockquote>"
+        self.assertNotIn("Old text", message_text(body))
+
+    def test_signature_and_disclaimer_are_removed(self):
+        body = ("Please ship today.\nBest regards,\nJane Doe\nPurchasing\n"
+                "CONFIDENTIALITY NOTICE: this e-mail is intended only for the addressee.")
+        self.assertEqual(message_text(body).strip(), "Please ship today.")
+
+    def test_quoted_text_does_not_make_a_reply_similar(self):
+        quoted = "Thanks, received.\n\nFrom: buyer@example.com\n" + PO_BODY
+        self.assertEqual(email_features("", quoted, []), email_features("", "Thanks, received.", []))
+
+
+class EvidenceTests(unittest.TestCase):
+    def test_attachment_key_ignores_order_and_case(self):
+        a = [{"name": "PO.pdf", "size": 10}, {"name": "terms.pdf", "size": 20}]
+        b = [{"name": "terms.PDF", "size": 20}, {"name": "po.pdf", "size": 10}]
+        self.assertEqual(attachment_key(a), attachment_key(b))
+        self.assertIsNone(attachment_key([]))
+
+    def test_attachment_key_includes_size(self):
+        self.assertNotEqual(attachment_key([{"name": "PO.pdf", "size": 10}]),
+                            attachment_key([{"name": "PO.pdf", "size": 11}]))
+
+    def test_po_key_collects_numbers_from_subject_and_own_text(self):
+        self.assertEqual(po_key("PO 4500123", "also purchase order #4500999"), "4500123,4500999")
+        self.assertEqual(po_key("", "Thanks.\nFrom: x@example.com\nPO 4500123"), None)
+
+    def test_corroborates_needs_non_empty_match(self):
+        fingerprint = Fingerprint(0, attachment_key=None, po_key="4500123")
+        self.assertTrue(fingerprint.corroborates("other", "4500123"))
+        self.assertFalse(fingerprint.corroborates(None, "4500124"))
+        self.assertFalse(Fingerprint(0).corroborates(None, None))
+
+
+class DuplicateIndexTests(unittest.TestCase):
+    def setUp(self):
+        handle, self.path = tempfile.mkstemp(suffix=".db")
+        os.close(handle)
+        self.index = DuplicateIndex(path=self.path, max_distance=3)
+
+    def tearDown(self):
+        self.index.close()
+        os.remove(self.path)
+
+    def test_match_within_threshold_with_same_attachments(self):
+        self.assertIsNone(self.index.check("a", Fingerprint(0b0000, "po.pdf:1"), category="Purchase Orders"))
+        match = self.index.check("b", Fingerprint(0b0111, "po.pdf:1"))
+        self.assertEqual((match["message_id"], match["category"], match["distance"]), ("a", "Purchase Orders", 3))
+
+    def test_no_match_beyond_threshold(self):
+        self.index.check("a", Fingerprint(0b0000, "po.pdf:1"))
+        self.assertIsNone(self.index.check("b", Fingerprint(0b1111, "po.pdf:1")))
+
+    def test_similar_text_without_shared_evidence_is_not_a_duplicate(self):
+        self.index.check("a", Fingerprint(0, "po-1.pdf:1", "4500123"))
+        self.assertIsNone(self.index.check("b", Fingerprint(0, "po-2.pdf:1", "4500124")))
+        self.assertIsNone(self.index.check("c", Fingerprint(0)))
+
+    def test_check_is_idempotent(self):
+        self.index.check("a", Fingerprint(0, None, "4500123"))
+        first = self.index.check("b", Fingerprint(1, None, "4500123"))
+        self.assertEqual(first["message_id"], "a")
+        self.assertEqual(self.index.check("b", Fingerprint(1, None, "4500123"))["message_id"], "a")
+        self.assertIsNone(self.index.check("a", Fingerprint(0, None, "4500123")))
+
+    def test_lookup_does_not_index(self):
+        self.assertIsNone(self.index.lookup("a", Fingerprint(0, "po.pdf:1")))
+        self.assertIsNone(self.index.check("b", Fingerprint(0, "po.pdf:1")))
+        self.assertEqual(self.index.lookup("c", Fingerprint(1, "po.pdf:1"))["message_id"], "b")
+        self.assertIsNone(self.index.check("c", Fingerprint((1 << 64) - 1, "po.pdf:1")))
+
+    def test_index_survives_reopen(self):
+        self.index.check("a", Fingerprint(0, "po.pdf:1"))
+        self.index.set_category("a", "Purchase Orders")
+        self.index.close()
+        self.index = DuplicateIndex(path=self.path, max_distance=3)
+        self.assertEqual(self.index.check("b", Fingerprint(1, "po.pdf:1"))["category"], "Purchase Orders")
+
+
+if __name__ == "__main__":
+    unittest.main()
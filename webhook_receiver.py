@@ -0,0 +1,304 @@
+import argparse
+import hmac
+import json
+import os
+import queue
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import requests
+from dotenv import load_dotenv
+
+from email_record import EmailRecord
+from graph_helper import (
+    create_inbox_subscription, get_emails_by_ids, get_inbox_delta, get_unread_emails, renew_subscription
+)
+from email_sorter import process_emails
+from mutation_queue import get_mutation_executor
+from app_logging import get_logger
+
+load_dotenv()
+
+logger = get_logger("webhook")
+
+# Push-driven sorting: Graph posts a change notification for every new Inbox message,
+# and the message IDs are sorted as they arrive instead of on a polling schedule.
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8765"))
+WEBHOOK_NOTIFICATION_URL = os.getenv("WEBHOOK_NOTIFICATION_URL")  # public HTTPS URL Graph can reach
+# Shared secret Graph echoes in every notification; required, and never a guessable default.
+WEBHOOK_CLIENT_STATE = os.getenv("WEBHOOK_CLIENT_STATE")
+WEBHOOK_STATE_PATH = os.getenv("WEBHOOK_STATE_PATH", "webhook_state.json")
+
+SUBSCRIPTION_LIFETIME = timedelta(days=2)           # Outlook message subscriptions last at most ~7 days
+SUBSCRIPTION_RENEW_BEFORE = timedelta(hours=12)
+SUBSCRIPTION_CHECK_SECONDS = 15 * 60
+DELTA_SYNC_SECONDS = int(os.getenv("WEBHOOK_DELTA_SYNC_SECONDS", str(15 * 60)))
+# Unread Inbox mail re-read on every delta sync, so messages the sorter held back are retried.
+UNREAD_SWEEP_SIZE = int(os.getenv("WEBHOOK_UNREAD_SWEEP_SIZE", "20"))
+BATCH_WAIT_SECONDS = 2.0  # collect notifications that arrive together into one sorting pass
+
+
+def load_state(path=WEBHOOK_STATE_PATH):
+    if os.path.exists(path):
+        with open(path, "r") as f:
+            return json.load(f)
+    return {}
+
+
+def save_state(state, path=WEBHOOK_STATE_PATH):
+    with open(path, "w") as f:
+        json.dump(state, f, indent=2)
+
+
+def _expiration_from_now():
+    return (datetime.now(timezone.utc) + SUBSCRIPTION_LIFETIME).strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+class NotificationReceiver:
+    """
+    Turns Graph change notifications into work-queue items.
+    Queue items are either message IDs (from notifications and delta sync) or EmailRecords
+    (from the unread sweep).
+    """
+
+    def __init__(self, work_queue, client_state=WEBHOOK_CLIENT_STATE):
+        self.work_queue = work_queue
+        self.client_state = client_state
+        self.resync_requested = threading.Event()
+        self.renew_requested = threading.Event()
+        self.notifications_received = 0
+
+    def handle_notifications(self, payload):
+        """Queues the message IDs in a notification payload. Returns how many were accepted."""
+        accepted = 0
+        for notification in payload.get("value", []):
+            if not hmac.compare_digest(str(notification.get("clientState") or ""), self.client_state):
+                logger.warning(f"⚠️ Ignoring notification with unexpected clientState for subscription {notification.get('subscriptionId')}.")
+                continue
+
+            lifecycle_event = notification.get("lifecycleEvent")
+            if lifecycle_event == "missed":
+                logger.warning("⚠️ Graph reports missed notifications; scheduling a delta sync.")
+                self.resync_requested.set()
+                continue
+            if lifecycle_event in ("reauthorizationRequired", "subscriptionRemoved"):
+                logger.warning(f"⚠️ Subscription lifecycle event '{lifecycle_event}'; scheduling renewal and delta sync.")
+                self.renew_requested.set()
+                self.resync_requested.set()
+                continue
+
+            message_id = (notification.get("resourceData") or {}).get("id")
+            if message_id:
+                self.work_queue.put(message_id)
+                accepted += 1
+        self.notifications_received += accepted
+        return accepted
+
+    def make_handler(self):
+        receiver = self
+
+        class NotificationHandler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                query = parse_qs(urlparse(self.path).query)
+                if "validationToken" in query:
+                    # Subscription validation handshake: echo the token back as plain text within 10 seconds.
+                    self._respond(200, query["validationToken"][0], "text/plain")
+                    return
+                try:
+                    length = int(self.headers.get("Content-Length", 0))
+                    payload = json.loads(self.rfile.read(length) or b"{}")
+                except (ValueError, json.JSONDecodeError):
+                    self._respond(400, "Invalid notification payload", "text/plain")
+                    return
+                receiver.handle_notifications(payload)
+                self._respond(202, "", "text/plain")
+
+            def _respond(self, status, body, content_type):
+                encoded = body.encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(encoded)))
+                self.end_headers()
+                self.wfile.write(encoded)
+
+            def log_message(self, format, *args):
+                pass  # one line per notification is too noisy; handle_notifications reports problems
+
+        return NotificationHandler
+
+
+def ensure_subscription(state, receiver):
+    """Creates the Inbox subscription if missing, or renews it when it is close to expiring."""
+    subscription_id = state.get("subscription_id")
+    expires = state.get("subscription_expires")
+    needs_renewal = receiver.renew_requested.is_set() or not expires or (
+        datetime.fromisoformat(expires.replace("Z", "+00:00")) - datetime.now(timezone.utc) < SUBSCRIPTION_RENEW_BEFORE
+    )
+    if subscription_id and not needs_renewal:
+        return
+
+    expiration = _expiration_from_now()
+    try:
+        if subscription_id:
+            renew_subscription(subscription_id, expiration)
+        else:
+            subscription = create_inbox_subscription(WEBHOOK_NOTIFICATION_URL, receiver.client_state, expiration)
+            state["subscription_id"] = subscription["id"]
+    except Exception as e:
+        logger.warning(f"⚠️ Could not renew subscription {subscription_id}: {e}. Creating a new one.")
+        subscription = create_inbox_subscription(WEBHOOK_NOTIFICATION_URL, receiver.client_state, expiration)
+        state["subscription_id"] = subscription["id"]
+        receiver.resync_requested.set()
+    state["subscription_expires"] = expiration
+    receiver.renew_requested.clear()
+    save_state(state)
+
+
+def run_delta_sync(state, work_queue):
+    """
+    Queues unread messages that arrived since the last delta link (covers missed notifications),
+    plus up to UNREAD_SWEEP_SIZE unread Inbox messages. The sweep retries mail the sorter held
+    back (e.g. a failed Airtable log), which the delta link has already moved past.
+    """
+    swept = get_unread_emails(folder_id="inbox", top_n=UNREAD_SWEEP_SIZE, expand_attachments=True)
+    for message in swept:
+        work_queue.put(message)
+
+    if not state.get("delta_link"):
+        # First sync only records where "now" is (ids only, no bodies); the rest of the existing
+        # backlog is worked off by the bounded sweep above, not in one unbounded burst here.
+        _, delta_link = get_inbox_delta()
+        if delta_link:
+            state["delta_link"] = delta_link
+            save_state(state)
+        logger.info(f"Delta sync seeded its link and swept {len(swept)} unread messages.")
+        return
+    messages, delta_link = get_inbox_delta(state.get("delta_link"))
+    swept_ids = {message.id for message in swept}
+    unread_ids = [msg.id for msg in messages if not msg.is_read and msg.id not in swept_ids]
+    for message_id in unread_ids:
+        work_queue.put(message_id)
+    if delta_link:
+        state["delta_link"] = delta_link
+        save_state(state)
+    logger.info(f"Delta sync queued {len(unread_ids)} new unread messages and swept {len(swept)}.")
+
+
+def sort_worker(work_queue, stop_event):
+    """Drains the work queue in small batches and hands each batch to process_emails."""
+    while not stop_event.is_set():
+        try:
+            items = [work_queue.get(timeout=1.0)]
+        except queue.Empty:
+            continue
+        deadline = time.monotonic() + BATCH_WAIT_SECONDS
+        while time.monotonic() < deadline:
+            try:
+                items.append(work_queue.get(timeout=max(0.0, deadline - time.monotonic())))
+            except queue.Empty:
+                break
+
+        message_ids = list(dict.fromkeys(item for item in items if isinstance(item, str)))
+        emails = [item for item in items if isinstance(item, EmailRecord)]
+        known_ids = {email.id for email in emails}
+        message_ids = [message_id for message_id in message_ids if message_id not in known_ids]
+        try:
+            if message_ids:
+                emails.extend(get_emails_by_ids(message_ids))
+            if emails:
+                process_emails(emails=emails)
+        except Exception as e:
+            logger.error(f"❌ Sorting batch of {len(items)} queued items failed: {e}")
+        finally:
+            for _ in items:
+                work_queue.task_done()
+
+
+def serve(subscribe=True):
+    if not WEBHOOK_CLIENT_STATE:
+        logger.critical("CRITICAL ERROR: WEBHOOK_CLIENT_STATE is not set; refusing to accept unauthenticated notifications.")
+        return
+    work_queue = queue.Queue()
+    receiver = NotificationReceiver(work_queue)
+    stop_event = threading.Event()
+    state = load_state()
+
+    server = ThreadingHTTPServer((WEBHOOK_HOST, WEBHOOK_PORT), receiver.make_handler())
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    threading.Thread(target=sort_worker, args=(work_queue, stop_event), daemon=True).start()
+    logger.info(f"📡 Listening for Graph change notifications on {WEBHOOK_HOST}:{WEBHOOK_PORT}")
+
+    if subscribe and not WEBHOOK_NOTIFICATION_URL:
+        logger.critical("CRITICAL ERROR: WEBHOOK_NOTIFICATION_URL is not set; cannot create a Graph subscription.")
+        subscribe = False
+
+    # Subscription upkeep and the delta-sync fallback run on this thread.
+    last_subscription_check = 0.0
+    last_delta_sync = time.monotonic() if not subscribe else 0.0
+    try:
+        while True:
+            now = time.monotonic()
+            if subscribe and (receiver.renew_requested.is_set() or now - last_subscription_check >= SUBSCRIPTION_CHECK_SECONDS):
+                try:
+                    ensure_subscription(state, receiver)
+                except Exception as e:
+                    logger.error(f"❌ Subscription upkeep failed: {e}")
+                last_subscription_check = now
+            if subscribe and (receiver.resync_requested.is_set() or now - last_delta_sync >= DELTA_SYNC_SECONDS):
+                receiver.resync_requested.clear()
+                try:
+                    run_delta_sync(state, work_queue)
+                except Exception as e:
+                    logger.error(f"❌ Delta sync failed: {e}")
+                last_delta_sync = now
+            time.sleep(1.0)
+    except KeyboardInterrupt:
+        logger.info("Stopping webhook receiver...")
+    finally:
+        stop_event.set()
+        server.shutdown()
+        get_mutation_executor().stop()
+
+
+def send_test_notification(url, message_id, client_state=WEBHOOK_CLIENT_STATE):
+    """
+    Local stand-in for Graph: performs the validation handshake against a running receiver,
+    then posts one 'created' notification for `message_id`.
+    """
+    token = "validation-check"
+    response = requests.post(f"{url}?validationToken={token}", timeout=10)
+    logger.info(f"Validation handshake: {response.status_code} echoed={response.text == token}")
+
+    payload = {"value": [{
+        "subscriptionId": "local-test",
+        "clientState": client_state,
+        "changeType": "created",
+        "resource": f"messages/{message_id}",
+        "resourceData": {"@odata.type": "#Microsoft.Graph.Message", "id": message_id}
+    }]}
+    response = requests.post(url, json=payload, timeout=10)
+    logger.info(f"Notification for message ID {message_id}: {response.status_code}")
+    return response.status_code
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Graph change-notification receiver for push-driven sorting.")
+    subcommands = parser.add_subparsers(dest="command")
+    serve_parser = subcommands.add_parser("serve", help="Run the receiver and sorting worker (default).")
+    serve_parser.add_argument("--no-subscribe", action="store_true",
+                              help="Don't create a Graph subscription or delta-sync; only accept posted notifications.")
+    test_parser = subcommands.add_parser("send-test", help="Post a fake notification to a running receiver.")
+    test_parser.add_argument("message_id")
+    test_parser.add_argument("--url", default=f"http://localhost:{WEBHOOK_PORT}/")
+    args = parser.parse_args()
+
+    if not WEBHOOK_CLIENT_STATE:
+        parser.error("WEBHOOK_CLIENT_STATE must be set (a long random secret shared with the Graph subscription).")
+    if args.command == "send-test":
+        send_test_notification(args.url, args.message_id)
+    else:
+        serve(subscribe=not getattr(args, "no_subscribe", False))